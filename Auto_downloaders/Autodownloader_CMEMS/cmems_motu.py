@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+'''
+    Purpose:    In-process client for the CMEMS Motu download service
+    Version:    v1.0 10/2026
+    Notes:      This code is offered with no warranty and under the MIT licence.
+
+    Speaks the same HTTP protocol as motu-client-python (CAS login, status
+    mode extraction requests, request status polling, download of the result)
+    but from inside the calling process, with one requests session. One CAS
+    login (ticket-granting ticket) is shared by every request and every
+    thread; each request only needs a cheap service ticket. The ticket-
+    granting ticket can also be kept in a cache file (readable by its owner
+    only) so that later runs reuse it until it expires or is rejected.
+
+    fetch_batch submits many extractions to the Motu queue at once, polls
+    them concurrently (backing off while they are in progress) and
+    downloads each one as soon as it is ready, so that the server side
+    extraction times overlap instead of adding up.
+
+    Usage:
+    client = MotuClient(motu_url, username, password, logging)
+    client.fetch(request, '/path/to/out.nc')
+    client.fetch_batch([(request, '/path/to/out.nc'), ...], callback)
+
+    where request is a dict with service_id, product_id, date_min, date_max,
+    lonmin, lonmax, latmin, latmax, (depth_min, depth_max) and variables.
+'''
+#-imports-----------------------------------------------------------------------
+import os
+import re
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from xml.etree import ElementTree
+
+import requests
+
+#-constants---------------------------------------------------------------------
+DEFAULT_MOTU_URL = 'http://motu.sltac.cls.fr/motu-web/Motu'
+
+# request status codes of a status mode request
+STATUS_INPROGRESS = '0'
+STATUS_DONE       = '1'
+STATUS_ERROR      = '2'
+STATUS_PENDING    = '3'
+
+# how long a cached ticket-granting ticket is trusted after it was last
+# used, in seconds (CAS servers expire idle tickets after about two hours)
+TGT_CACHE_TTL = 5400.
+
+# size units of a getsize reply, in kb
+SIZE_UNITS = {'b': 1./1024, 'kb': 1., 'mb': 1024., 'gb': 1024.**2}
+
+#-classes-----------------------------------------------------------------------
+class MotuError(Exception):
+    # the Motu server refused or failed a request
+    pass
+
+class MotuClient(object):
+    # one authenticated session against a Motu server, safe to share
+    # between threads
+
+    def __init__(self, motu_url, username, password, logging, auth_mode='cas',
+                 timeout=120., poll_interval=10., pool_size=8, tgt_cache=None,
+                 tgt_cache_ttl=TGT_CACHE_TTL):
+        self.motu_url      = motu_url
+        self.username      = username
+        self.password      = password
+        self.logging       = logging
+        self.auth_mode     = auth_mode
+        self.timeout       = timeout
+        self.poll_interval = poll_interval
+        self.lock          = threading.Lock()
+        self.cas_url       = None
+        self.tgt_url       = None
+        self.tgt_cache     = tgt_cache
+        self.tgt_cache_ttl = tgt_cache_ttl
+        self.tgt_used      = 0.
+
+        self.session = requests.Session()
+        adaptor = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, max_retries=3)
+        self.session.mount('http://', adaptor)
+        self.session.mount('https://', adaptor)
+        if auth_mode == 'basic':
+            self.session.auth = (username, password)
+
+    def close(self):
+        self.session.close()
+
+    #-authentication------------------------------------------------------------
+    def cache_key(self):
+        # cache entry of our credentials on this server
+        return self.username+'@'+self.motu_url
+
+    def read_tgt_cache(self):
+        # all entries of the ticket cache file
+        if self.tgt_cache is None or not os.path.exists(self.tgt_cache):
+            return {}
+        try:
+            with open(self.tgt_cache) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def write_tgt_cache(self):
+        # save our ticket-granting ticket (or forget it, if we have none),
+        # atomically and readable by the owner only
+        if self.tgt_cache is None:
+            return
+        cache = self.read_tgt_cache()
+        if self.tgt_url is None:
+            cache.pop(self.cache_key(), None)
+        else:
+            cache[self.cache_key()] = {'cas_url': self.cas_url, 'tgt_url': self.tgt_url,
+                                       'used': self.tgt_used}
+        try:
+            fd = os.open(self.tgt_cache+'.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(cache, f)
+            os.chmod(self.tgt_cache+'.tmp', 0o600)
+            os.replace(self.tgt_cache+'.tmp', self.tgt_cache)
+        except (IOError, OSError) as err:
+            self.logging.warning('Cannot write CAS ticket cache %s: %s'%(self.tgt_cache,err))
+
+    def cached_tgt(self):
+        # a ticket-granting ticket of an earlier run that has not expired
+        entry = self.read_tgt_cache().get(self.cache_key())
+        if entry is None or time.time() - entry.get('used', 0.) > self.tgt_cache_ttl:
+            return None
+
+        return entry
+
+    def login(self, stale=None):
+        # CAS login: find the CAS server the Motu server redirects to, and get
+        # a ticket-granting ticket for our credentials. Threads that find the
+        # same stale ticket log in only once. The first login tries the
+        # ticket cache.
+        with self.lock:
+            if self.tgt_url is not None and self.tgt_url != stale:
+                return
+            if stale is None:
+                entry = self.cached_tgt()
+                if entry is not None:
+                    self.cas_url  = entry['cas_url']
+                    self.tgt_url  = entry['tgt_url']
+                    self.tgt_used = entry['used']
+                    self.logging.info('Using cached CAS login for '+self.cas_url)
+                    return
+            if self.cas_url is None:
+                r = self.session.get(self.motu_url, timeout=self.timeout)
+                match = re.search('(.+)/login.*', r.url)
+                if match is None:
+                    raise MotuError('Motu server does not redirect to a CAS login page: '+r.url)
+                self.cas_url = match.group(1)
+
+            r = self.session.post(self.cas_url+'/v1/tickets', timeout=self.timeout,
+                                  data={'username': self.username, 'password': self.password})
+            if r.status_code != 201 or 'location' not in r.headers:
+                self.tgt_url = None
+                self.write_tgt_cache()
+                raise MotuError('CAS login refused for user %s (code %i)'%(self.username,r.status_code))
+            self.tgt_url  = r.headers['location']
+            self.tgt_used = time.time()
+            self.write_tgt_cache()
+            self.logging.info('Logged in to '+self.cas_url)
+
+    def ticket_used(self, tgt_url):
+        # note that a ticket-granting ticket still works; the cache file is
+        # only rewritten once a minute
+        with self.lock:
+            if tgt_url == self.tgt_url and time.time() - self.tgt_used > 60.:
+                self.tgt_used = time.time()
+                self.write_tgt_cache()
+
+    def service_ticket(self, url):
+        # one-time ticket for a service url, from the ticket-granting ticket
+        # (logging in again if there is none yet or it has expired)
+        tgt_url = self.tgt_url
+        for attempt in range(2):
+            if tgt_url is None or attempt > 0:
+                self.login(stale=tgt_url)
+                tgt_url = self.tgt_url
+            r = self.session.post(tgt_url, data={'service': url}, timeout=self.timeout)
+            if r.status_code == 200:
+                self.ticket_used(tgt_url)
+                return r.text.strip()
+            self.logging.info('CAS ticket-granting ticket rejected (code %i)'%r.status_code)
+
+        raise MotuError('Cannot get a CAS service ticket for '+url)
+
+    def get(self, params, stream=False):
+        # GET the Motu server with the given (list of) parameters
+        url = requests.Request('GET', self.motu_url, params=params).prepare().url
+        if self.auth_mode == 'cas':
+            url = url + '&ticket=' + self.service_ticket(url)
+
+        r = self.session.get(url, stream=stream, timeout=self.timeout)
+        if r.status_code != 200:
+            raise MotuError('Motu request failed (code %i): %s'%(r.status_code,r.text[:200]))
+
+        return r
+
+    #-requests------------------------------------------------------------------
+    def extraction_params(self, request):
+        # Motu query parameters of an extraction request
+        params = [('service', request['service_id']), ('product', request['product_id']),
+                  ('x_lo', request['lonmin']), ('x_hi', request['lonmax']),
+                  ('y_lo', request['latmin']), ('y_hi', request['latmax']),
+                  ('t_lo', request['date_min']), ('t_hi', request['date_max'])]
+        if request.get('depth_min') not in (None, ''):
+            params.append(('z_lo', request['depth_min']))
+        if request.get('depth_max') not in (None, ''):
+            params.append(('z_hi', request['depth_max']))
+        for variable in request['variables']:
+            params.append(('variable', variable))
+        params.append(('output', request.get('output', 'netcdf')))
+
+        return params
+
+    def parse_status(self, text):
+        # (status, remote url, message, request id) of a statusModeResponse
+        try:
+            node = ElementTree.fromstring(text)
+        except ElementTree.ParseError:
+            raise MotuError('Unexpected reply from Motu server: '+text[:200])
+        if node.tag != 'statusModeResponse':
+            node = node.find('.//statusModeResponse')
+        if node is None:
+            raise MotuError('Unexpected reply from Motu server: '+text[:200])
+
+        return node.get('status'), node.get('remoteUri'), node.get('msg'), node.get('requestId')
+
+    def get_size(self, request):
+        # (size, maximum allowed size), in kb, of an extraction request
+        r = self.get([('action', 'getsize')] + self.extraction_params(request))
+        try:
+            node = ElementTree.fromstring(r.text)
+        except ElementTree.ParseError:
+            raise MotuError('Unexpected reply from Motu server: '+r.text[:200])
+        if node.tag != 'requestSize':
+            node = node.find('.//requestSize')
+        if node is None or node.get('size') is None:
+            raise MotuError('Unexpected reply from Motu server: '+r.text[:200])
+
+        scale = SIZE_UNITS.get(str(node.get('unit', 'kb')).lower(), 1.)
+        size  = float(node.get('size'))
+        if size < 0:
+            raise MotuError('Size request refused: '+str(node.get('msg')))
+        max_size = node.get('maxAllowedSize')
+        max_size = float(max_size)*scale if max_size not in (None, '') and float(max_size) > 0 else None
+
+        return size*scale, max_size
+
+    def submit(self, request):
+        # queue an extraction (status mode); returns its request id
+        r = self.get([('action', 'productdownload'), ('mode', 'status')] + self.extraction_params(request))
+        status, remote_uri, msg, request_id = self.parse_status(r.text)
+        if status == STATUS_ERROR or request_id in (None, ''):
+            raise MotuError('Extraction refused: '+str(msg))
+
+        return request_id
+
+    def status(self, request_id, request):
+        # (status, remote url, message) of a queued extraction
+        r = self.get([('action', 'getreqstatus'), ('requestid', request_id),
+                      ('service', request['service_id']), ('product', request['product_id'])])
+        status, remote_uri, msg, rid = self.parse_status(r.text)
+
+        return status, remote_uri, msg
+
+    def wait(self, request_id, request):
+        # poll a queued extraction until it is ready; returns its url
+        while True:
+            status, remote_uri, msg = self.status(request_id, request)
+            if status == STATUS_DONE:
+                return remote_uri
+            if status == STATUS_ERROR:
+                raise MotuError('Extraction failed: '+str(msg))
+            time.sleep(self.poll_interval)
+
+    def download(self, url, fname, block_size=1024*1024):
+        # stream an extraction result into fname (via a temporary file, so
+        # that fname only ever holds a complete file); returns its size
+        r = self.session.get(url, stream=True, timeout=self.timeout)
+        try:
+            if r.status_code != 200:
+                raise MotuError('Download of %s failed (code %i)'%(url,r.status_code))
+            with open(fname+'.part', 'wb') as f:
+                for chunk in r.iter_content(chunk_size=block_size):
+                    f.write(chunk)
+        finally:
+            r.close()
+        os.replace(fname+'.part', fname)
+
+        return os.path.getsize(fname)
+
+    def fetch(self, request, fname):
+        # submit an extraction, wait for it and download it into fname;
+        # returns the size of the file
+        request_id = self.submit(request)
+        self.logging.info('Extraction %s queued for %s'%(request_id,os.path.basename(fname)))
+        remote_uri = self.wait(request_id, request)
+
+        return self.download(remote_uri, fname)
+
+    def fetch_batch(self, jobs, callback, workers=4, max_queued=16, first_poll=2., max_poll=60.,
+                    max_poll_errors=3):
+        # fetch many (request, fname) jobs: up to max_queued extractions are
+        # queued on the server at once, their status is polled concurrently
+        # (the interval of each doubles from first_poll up to max_poll while
+        # it is not ready) and up to workers results are downloaded at once.
+        # callback(index, size, error, seconds) is called, from this thread,
+        # as each job ends; error is None if it succeeded.
+        control  = ThreadPoolExecutor(max_workers=max(workers, 4))
+        download = ThreadPoolExecutor(max_workers=max(workers, 1))
+        waiting  = list(range(len(jobs)))[::-1]
+        started  = {}       # index: time of submission, until the job ends
+        polls    = {}       # index: [request id, next poll, interval, failed polls]
+        running  = {}       # future: (kind, index)
+
+        def finish(ii, size, error):
+            polls.pop(ii, None)
+            callback(ii, size, error, time.time() - started.pop(ii))
+
+        try:
+            while waiting or polls or running:
+                # queue more extractions, up to max_queued
+                n_queued = len(started) - len([1 for kind, ii in running.values() if kind == 'download'])
+                while waiting and n_queued < max_queued:
+                    ii = waiting.pop()
+                    started[ii] = time.time()
+                    running[control.submit(self.submit, jobs[ii][0])] = ('submit', ii)
+                    n_queued = n_queued + 1
+
+                # poll the extractions that are due
+                polling = set([ii for kind, ii in running.values() if kind == 'status'])
+                for ii, poll in polls.items():
+                    if ii not in polling and poll[1] <= time.time():
+                        running[control.submit(self.status, poll[0], jobs[ii][0])] = ('status', ii)
+
+                # wait for a reply, or for the next poll
+                due = [poll[1] for ii, poll in polls.items() if ii not in polling]
+                timeout = max(min(due) - time.time(), 0.) if due else None
+                if running:
+                    done = wait(list(running), timeout=timeout, return_when=FIRST_COMPLETED)[0]
+                else:
+                    time.sleep(timeout or 0.)
+                    done = []
+
+                for future in done:
+                    kind, ii = running.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as err:
+                        # a failed poll is tried again, up to a point
+                        if kind == 'status' and polls[ii][3] + 1 < max_poll_errors:
+                            polls[ii][3] = polls[ii][3] + 1
+                            polls[ii][1] = time.time() + polls[ii][2]
+                        else:
+                            finish(ii, 0, err)
+                        continue
+
+                    if kind == 'submit':
+                        self.logging.info('Extraction %s queued for %s'%(result,os.path.basename(jobs[ii][1])))
+                        polls[ii] = [result, time.time() + first_poll, first_poll, 0]
+                    elif kind == 'status':
+                        status, remote_uri, msg = result
+                        if status == STATUS_DONE:
+                            del polls[ii]
+                            running[download.submit(self.download, remote_uri, jobs[ii][1])] = ('download', ii)
+                        elif status == STATUS_ERROR:
+                            finish(ii, 0, MotuError('Extraction failed: '+str(msg)))
+                        else:
+                            polls[ii][2] = min(polls[ii][2]*2., max_poll)
+                            polls[ii][1] = time.time() + polls[ii][2]
+                            polls[ii][3] = 0
+                    else:
+                        finish(ii, result, None)
+        finally:
+            control.shutdown(wait=False)
+            download.shutdown(wait=True)
+
+#-EOF
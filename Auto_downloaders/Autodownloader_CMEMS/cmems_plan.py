@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+'''
+    Purpose:    Size-aware planning and merging of CMEMS extractions
+    Version:    v1.0 10/2026
+    Notes:      This code is offered with no warranty and under the MIT licence.
+
+    plan_requests asks the Motu server for the size of an extraction (the
+    same getsize query as motu-client.py --size) and, if it is over the
+    server's limit, cuts it into the largest pieces that are not: first
+    along time (whole days), then by variable, then in latitude bands.
+
+    merge_netcdf puts the downloaded pieces back together into one NetCDF
+    file, one variable of one piece (and a block of records at a time) in
+    memory, whatever the size of the whole extraction.
+
+    Usage:
+    chunks = plan_requests(client, request, logging)
+    ... fetch every chunk into a piece file ...
+    merge_netcdf(piece_files, '/path/to/out.nc', logging)
+'''
+#-imports-----------------------------------------------------------------------
+import os
+import math
+import datetime
+
+import numpy as np
+from netCDF4 import Dataset, num2date, date2num
+
+from cmems_motu import MotuError
+
+#-constants---------------------------------------------------------------------
+# fraction of the server's size limit that a planned chunk may use: sizes
+# are estimated by scaling, and the server's own estimate is not exact
+SIZE_MARGIN = 0.9
+
+# largest block of a variable copied at once when merging, in bytes
+MERGE_BLOCK = 64*1024*1024
+
+#-planning----------------------------------------------------------------------
+def request_days(request):
+    # the days of a request, first to last
+    date_min = datetime.datetime.strptime(request['date_min'][:10], '%Y-%m-%d')
+    date_max = datetime.datetime.strptime(request['date_max'][:10], '%Y-%m-%d')
+
+    return [date_min + datetime.timedelta(days=ii) for ii in range((date_max - date_min).days + 1)]
+
+def split_request(request, size, limit):
+    # cut a request of the given size into the fewest pieces of at most
+    # limit, assuming that size scales with days, variables and latitude
+    days      = request_days(request)
+    variables = list(request['variables'])
+    if size <= limit:
+        return [dict(request)]
+
+    # whole days per chunk
+    per_day = size / len(days)
+    if per_day <= limit:
+        n_days = max(int(limit // per_day), 1)
+        chunks = []
+        for ii in range(0, len(days), n_days):
+            chunk = dict(request)
+            chunk['date_min'] = days[ii].strftime('%Y-%m-%d')
+            chunk['date_max'] = days[min(ii+n_days, len(days))-1].strftime('%Y-%m-%d')
+            chunks.append(chunk)
+        return chunks
+
+    # one day per chunk, and groups of variables
+    per_var = per_day / len(variables)
+    if per_var <= limit:
+        n_vars = max(int(limit // per_var), 1)
+        groups = [variables[ii:ii+n_vars] for ii in range(0, len(variables), n_vars)]
+        bands  = [(request['latmin'], request['latmax'])]
+    else:
+        # one variable per chunk, in latitude bands
+        groups  = [[variable] for variable in variables]
+        n_bands = int(math.ceil(per_var / limit))
+        latmin  = float(request['latmin'])
+        step    = (float(request['latmax']) - latmin) / n_bands
+        bands   = [(str(round(latmin + ii*step, 6)), str(round(latmin + (ii+1)*step, 6)))
+                   for ii in range(n_bands)]
+        bands[-1] = (bands[-1][0], request['latmax'])
+
+    chunks = []
+    for day in days:
+        for group in groups:
+            for band in bands:
+                chunk = dict(request)
+                chunk['date_min']  = day.strftime('%Y-%m-%d')
+                chunk['date_max']  = day.strftime('%Y-%m-%d')
+                chunk['variables'] = group
+                chunk['latmin'], chunk['latmax'] = band
+                chunks.append(chunk)
+
+    return chunks
+
+def plan_requests(client, request, logging, max_size=None):
+    # the largest chunks of a request that the server will accept. The
+    # first chunk is always one of the largest, so it is the one we check
+    # with the server; if the scaled estimate was too low we plan again
+    # with a smaller target.
+    size, max_allowed = client.get_size(request)
+    if max_allowed is None and max_size is None:
+        logging.info('No size limit for %s (%.0f kb): one request'%(request['product_id'],size))
+        return [dict(request)]
+    limit  = min([mm for mm in (max_allowed, max_size) if mm is not None]) * SIZE_MARGIN
+    target = limit
+
+    for attempt in range(5):
+        chunks = split_request(request, size, target)
+        if len(chunks) == 1:
+            return chunks
+        chunk_size, max_allowed = client.get_size(chunks[0])
+        if chunk_size <= limit:
+            logging.info('%s: %.0f kb in %i requests of at most %.0f kb'%\
+                         (request['product_id'],size,len(chunks),chunk_size))
+            return chunks
+        target = target * limit / chunk_size * SIZE_MARGIN
+
+    raise MotuError('Cannot plan %s under the size limit of %.0f kb'%(request['product_id'],limit))
+
+#-merging-----------------------------------------------------------------------
+def coordinate_values(var, units, calendar):
+    # values of a coordinate variable, in the units of the first piece
+    values = var[:]
+    var_units = getattr(var, 'units', units)
+    if units is not None and var_units != units and 'since' in str(units):
+        values = date2num(num2date(values, var_units, calendar), units, calendar)
+
+    return np.asarray(values)
+
+def coordinate_index(out_values, values):
+    # positions of values in a (monotonic) output coordinate
+    descending = len(out_values) > 1 and out_values[0] > out_values[-1]
+    ordered    = out_values[::-1] if descending else out_values
+    pos = np.clip(np.searchsorted(ordered, values), 0, len(ordered)-1)
+    if not np.allclose(ordered[pos], values):
+        raise Exception('Pieces do not share a coordinate grid')
+    if descending:
+        pos = len(ordered) - 1 - pos
+
+    return pos
+
+def as_index(pos):
+    # a slice if the positions are contiguous (much faster to write)
+    if len(pos) > 0 and np.all(np.diff(pos) == 1):
+        return slice(int(pos[0]), int(pos[-1])+1)
+
+    return pos
+
+def merge_netcdf(pieces, out_fname, logging):
+    # merge NetCDF pieces of one extraction (split along any coordinate,
+    # or by variable) into out_fname, streaming the data
+    coords  = {}
+    units   = {}
+    dims    = {}
+    var_def = {}
+
+    # pass 1: the coordinates and variables of every piece (metadata only)
+    for fname in pieces:
+        with Dataset(fname) as src:
+            src.set_auto_maskandscale(False)
+            for name, dim in src.dimensions.items():
+                if name not in dims:
+                    dims[name] = (len(dim), dim.isunlimited())
+                if name in src.variables:
+                    var = src.variables[name]
+                    if name not in units:
+                        units[name] = (getattr(var, 'units', None), getattr(var, 'calendar', 'standard'))
+                    coords.setdefault(name, []).append(coordinate_values(var, *units[name]))
+            for name in src.variables:
+                if name not in var_def:
+                    var_def[name] = fname
+
+    out_coords = {}
+    for name, values in coords.items():
+        merged = np.unique(np.concatenate(values))
+        if values[0].size > 1 and values[0][0] > values[0][-1]:
+            merged = merged[::-1]
+        out_coords[name] = merged
+
+    with Dataset(pieces[0]) as first:
+        data_model = first.data_model
+        global_atts = dict((att, first.getncattr(att)) for att in first.ncattrs())
+
+    dst = Dataset(out_fname+'.part', 'w', format=data_model)
+    try:
+        dst.set_auto_maskandscale(False)
+        dst.setncatts(global_atts)
+        for name, (size, unlimited) in dims.items():
+            dst.createDimension(name, None if unlimited else len(out_coords.get(name, range(size))))
+
+        for name, fname in var_def.items():
+            with Dataset(fname) as src:
+                var = src.variables[name]
+                atts = dict((att, var.getncattr(att)) for att in var.ncattrs() if att != '_FillValue')
+                kwargs = {'fill_value': getattr(var, '_FillValue', None)}
+                if data_model.startswith('NETCDF4'):
+                    filters = var.filters() or {}
+                    kwargs.update(zlib=bool(filters.get('zlib')), complevel=filters.get('complevel', 4),
+                                  shuffle=bool(filters.get('shuffle')))
+                out_var = dst.createVariable(name, var.dtype, var.dimensions, **kwargs)
+                out_var.set_auto_maskandscale(False)
+                out_var.setncatts(atts)
+
+        for name, values in out_coords.items():
+            dst.variables[name][:] = values.astype(dst.variables[name].dtype)
+
+        # pass 2: the data, one variable of one piece at a time
+        for fname in pieces:
+            with Dataset(fname) as src:
+                src.set_auto_maskandscale(False)
+                for name, var in src.variables.items():
+                    if name in out_coords:
+                        continue
+                    if len(var.dimensions) == 0:
+                        dst.variables[name].assignValue(var.getValue())
+                        continue
+                    index = []
+                    for dim in var.dimensions:
+                        if dim in out_coords:
+                            piece_values = coordinate_values(src.variables[dim], *units[dim])
+                            index.append(coordinate_index(out_coords[dim], piece_values))
+                        else:
+                            index.append(np.arange(len(src.dimensions[dim])))
+
+                    # copy in blocks of records along the first dimension
+                    record = var.dtype.itemsize * int(np.prod(var.shape[1:]))
+                    step   = max(int(MERGE_BLOCK // max(record, 1)), 1)
+                    for i0 in range(0, var.shape[0], step):
+                        i1 = min(i0+step, var.shape[0])
+                        out_index = tuple([as_index(index[0][i0:i1])] + [as_index(ii) for ii in index[1:]])
+                        dst.variables[name][out_index] = var[i0:i1]
+            logging.info('Merged '+os.path.basename(fname))
+    finally:
+        dst.close()
+
+    os.replace(out_fname+'.part', out_fname)
+
+    return os.path.getsize(out_fname)
+
+#-EOF
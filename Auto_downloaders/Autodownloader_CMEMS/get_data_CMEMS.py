@@ -3,58 +3,113 @@
     Purpose:    Wrapper script for calling Python motu client for CMEMS downloading
     Version:    v1.0 02/2018
     Author:     Ben Loveday, Plymouth Marine Laboratory
-    Notes:      Require opython-motu client
+    Notes:      Drives the Motu API in-process (see cmems_motu.py): one CAS
+                login, kept in --tgt_cache for later runs until it expires,
+                and --workers days downloaded at the same time. The state of every day is written to a
+                results table (CSV) next to the log file.
+                With --plan, the whole date range is instead cut into the
+                largest requests the server accepts (see cmems_plan.py),
+                which are downloaded in parallel and merged into one file.
+                Up to --queued extractions are queued on the server at once,
+                and each is downloaded as soon as it is ready.
+                With --incremental, the output directory is kept: files
+                that are already there and valid (see .cmems_manifest.json)
+                are not downloaded again.
 '''
 #-imports-----------------------------------------------------------------------
 import os, sys, shutil
 import argparse
 import logging
 import datetime
-import subprocess
+import csv
+import json
 
+from cmems_motu import MotuClient, MotuError, DEFAULT_MOTU_URL
+from cmems_plan import plan_requests, merge_netcdf
+from netCDF4 import Dataset, num2date
 
 #-functions---------------------------------------------------------------------
-def download_data(Command, logging, verbose=False):
-    
-    processed_state = 'Downloaded ok'
-    logging.info('Launching download CMD:  '+Command)
-    
+def job_result(request, outname, size, error, seconds, logging):
+    # a row of the results table for one finished extraction
+    result = {'date': request['date_min'], 'file': outname, 'state': 'failed',
+              'bytes': size, 'seconds': round(seconds, 1), 'message': ''}
+    if error is None:
+        result['state']   = 'downloaded'
+        result['message'] = 'Downloaded ok'
+        logging.info('Downloaded '+outname)
+    elif isinstance(error, (MotuError, IOError, OSError)):
+        result['message'] = str(error)
+        logging.error('Download of '+outname+' failed: '+str(error))
+    else:
+        result['message'] = 'Unknown Error: '+str(error)
+        logging.error('Download of '+outname+' failed: '+str(error))
+
+    return result
+
+def write_results(results, fname):
+    # the results table: one row per requested file
+    with open(fname, 'w') as f:
+        writer = csv.DictWriter(f, fieldnames=['date','file','state','bytes','seconds','message'])
+        writer.writeheader()
+        for result in results:
+            writer.writerow(result)
+
+def read_manifest(fname):
+    # completion state of the files of earlier runs, by file name
+    if not os.path.exists(fname):
+        return {}
     try:
-        process = subprocess.Popen(CMD, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True)
-        process.wait()
-        
-        # Poll process for new output until finished
-        while True:
-            nextline = process.stdout.readline()
-            if nextline == '' and process.poll() is not None:
-                break
-            if nextline !='':
-                logging.info(nextline)
-            if 'Error' in nextline:
-                processed_state = nextline
-            sys.stdout.flush()
-    
-        output   = process.communicate()[0]
-        exitCode = process.returncode
-        
-        if (exitCode == 0):
-            logging.info('Downloading successful')
-            processed_flag = True
-        else:
-            logging.error('Something went wrong in downloading: see above')
-            processed_flag = False
-    except:
-        logging.info('Downloading unsuccessful')
-        processed_flag = False
-        processed_state = 'Unknown Error'
-    
-    return processed_flag, processed_state
+        with open(fname) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def write_manifest(manifest, fname):
+    # write the manifest atomically, so that a crash never leaves half of one
+    with open(fname+'.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(fname+'.tmp', fname)
+
+def manifest_entry(request, fname):
+    # what the manifest records for a complete file
+    return {'date_min': request['date_min'], 'date_max': request['date_max'],
+            'variables': list(request['variables']),
+            'area': [request['lonmin'], request['lonmax'], request['latmin'], request['latmax']],
+            'bytes': os.path.getsize(fname), 'mtime': os.path.getmtime(fname),
+            'completed': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')}
+
+def valid_file(request, fname, entry):
+    # is fname a complete extraction of request? Files recorded in the
+    # manifest and untouched since are trusted; others are opened and
+    # checked for the requested variables and time coverage
+    if not os.path.exists(fname):
+        return False
+    if entry is not None and entry.get('bytes') == os.path.getsize(fname) and \
+       entry.get('mtime') == os.path.getmtime(fname):
+        expected = manifest_entry(request, fname)
+        return all([entry.get(key) == expected[key] for key in ('date_min','date_max','variables','area')])
+
+    t_min = datetime.datetime.strptime(request['date_min'][:10], '%Y-%m-%d')
+    t_max = datetime.datetime.strptime(request['date_max'][:10], '%Y-%m-%d') + datetime.timedelta(days=1)
+    try:
+        with Dataset(fname) as nc:
+            if not all([variable in nc.variables for variable in request['variables']]):
+                return False
+            time_var = nc.variables['time']
+            times = num2date(time_var[:], time_var.units, getattr(time_var, 'calendar', 'standard'),
+                             only_use_cftime_datetimes=False, only_use_python_datetimes=True)
+    except Exception:
+        return False
+    if len(times) == 0:
+        return False
+
+    return min(times) >= t_min and max(times) < t_max
 
 #-default parameters------------------------------------------------------------
 DEFAULT_LOG_PATH    = os.getcwd()
 DEFAULT_CFG_FILE    = os.path.join(os.getcwd(),'CMEMS_download.cfg')
-DEFAULT_MOTU_PATH   = os.getcwd()
 DEFAULT_OUT_DIR     = os.path.join(os.getcwd(),'DATA')
+DEFAULT_TGT_CACHE   = os.path.join(os.path.expanduser('~'),'.cmems_tgt_cache')
 
 #-args--------------------------------------------------------------------------
 parser = argparse.ArgumentParser()
@@ -72,10 +127,35 @@ parser.add_argument("-log", "--log_path",\
                     type=str,\
                     default=DEFAULT_LOG_PATH,\
                     help="Log file path")
-parser.add_argument("-motu", "--motu_path",\
+parser.add_argument("-motu", "--motu_url",\
                     type=str,\
-                    default=DEFAULT_MOTU_PATH,\
-                    help="Motu client file path")
+                    default=DEFAULT_MOTU_URL,\
+                    help="Motu server")
+parser.add_argument("-tgt", "--tgt_cache",\
+                    type=str,\
+                    default=DEFAULT_TGT_CACHE,\
+                    help="File in which the CAS login is kept between runs")
+parser.add_argument("-nc", "--no_tgt_cache",\
+                    action='store_true',\
+                    help="Do not keep the CAS login between runs")
+parser.add_argument("-w", "--workers",\
+                    type=int,\
+                    default=4,\
+                    help="Number of downloads at the same time")
+parser.add_argument("-q", "--queued",\
+                    type=int,\
+                    default=16,\
+                    help="Number of extractions queued on the server at the same time")
+parser.add_argument("-plan", "--plan",\
+                    action='store_true',\
+                    help="Size-aware requests merged into one output file, instead of one file per day")
+parser.add_argument("-max", "--max_size",\
+                    type=float,\
+                    default=None,\
+                    help="Largest request in kb with --plan (default: the server's limit)")
+parser.add_argument("-i", "--incremental",\
+                    action='store_true',\
+                    help="Keep the output directory and only download missing or invalid files")
 parser.add_argument("-o", "--output_dir",\
                     type=str,\
                     default=DEFAULT_OUT_DIR,\
@@ -116,7 +196,7 @@ if __name__ == "__main__":
         sys.exit()
 
     # set our variables
-    motu_path  = args.motu_path
+    motu_url   = config_dict.get("motu", args.motu_url)
     username   = args.username
     password   = args.password
     outdir     = args.output_dir
@@ -130,26 +210,116 @@ if __name__ == "__main__":
     latmax     = config_dict["latmax"]
     variables  = config_dict["variables"].split(',')
 
-    # clear the output directory and make a new one
-    if os.path.exists(outdir):
+    # clear the output directory and make a new one, unless we are only
+    # adding what is missing
+    if os.path.exists(outdir) and not args.incremental:
         shutil.rmtree(outdir)
-    os.mkdir(outdir)
+    if not os.path.exists(outdir):
+        os.mkdir(outdir)
+    manifest_file = os.path.join(outdir, '.cmems_manifest.json')
+    manifest      = read_manifest(manifest_file)
     
-    # set variables
-    v_string=' --variable '
-    all_variables = ' '
-    for vv in variables:
-        all_variables=v_string+"'"+vv+"'"+all_variables
-
-    print all_variables
-    # loop through dates
-    this_date = date_min
-    while this_date <= date_max:
-        date_format=this_date.strftime('%Y-%m-%d')
-        outname = product_id+'_'+date_format+'.nc'
-        print('Saving to: '+outname)
-        this_date = this_date + datetime.timedelta(days=1)
-        CMD="python "+motu_path+"/motu-client-python/motu-client.py --user '"+username+"' --pwd '"+password+"' --motu 'http://motu.sltac.cls.fr/motu-web/Motu' --service-id '"+service_id+"' --product-id '"+product_id+"' --longitude-min '"+str(lonmin)+" ' --longitude-max '"+str(lonmax)+"' --latitude-min '"+str(latmin)+"' --latitude-max '"+str(latmax)+"' --date-min '"+date_format+"' --date-max '"+date_format+"' "+all_variables+" --out-dir '"+outdir+"' --out-name '"+outname+"'"
+    request = {'service_id': service_id, 'product_id': product_id,
+               'date_min': date_min.strftime('%Y-%m-%d'), 'date_max': date_max.strftime('%Y-%m-%d'),
+               'lonmin': lonmin, 'lonmax': lonmax, 'latmin': latmin, 'latmax': latmax,
+               'variables': variables}
+
+    # with --plan, everything goes into one file
+    outname = config_dict.get("outname", product_id+'_'+request['date_min']+'_'+request['date_max']+'.nc')
+    if args.plan and args.incremental and \
+       valid_file(request, os.path.join(outdir, outname), manifest.get(outname)):
+        logging.info(outname+' is already complete')
+        print(outname+' is already complete')
+        sys.exit(0)
+
+    # one authenticated session, shared by all workers
+    client = MotuClient(motu_url, username, password, logging, pool_size=max(args.workers,1)+4,
+                        tgt_cache=None if args.no_tgt_cache else args.tgt_cache)
+    try:
+        jobs = []
+        if args.plan:
+            # the largest requests under the server's size limit, downloaded
+            # as pieces and merged into one file
+            part_dir = os.path.join(outdir, '.parts')
+            if not os.path.exists(part_dir):
+                os.mkdir(part_dir)
+            try:
+                chunks = plan_requests(client, request, logging, max_size=args.max_size)
+            except MotuError as err:
+                logging.error('Planning failed: '+str(err))
+                print('FAILED planning: '+str(err))
+                sys.exit(1)
+            for ii, chunk in enumerate(chunks):
+                jobs.append((chunk, os.path.join('.parts', '%s_%04i.nc'%(product_id, ii))))
+        else:
+            # one request per day
+            this_date = date_min
+            while this_date <= date_max:
+                date_format=this_date.strftime('%Y-%m-%d')
+                day_request = dict(request)
+                day_request['date_min'] = date_format
+                day_request['date_max'] = date_format
+                jobs.append((day_request, product_id+'_'+date_format+'.nc'))
+                this_date = this_date + datetime.timedelta(days=1)
         if verbose:
-            print CMD
-        flag, state = download_data(CMD,logging)
+            for job_request, job_name in jobs:
+                print('Saving to: '+job_name)
+
+        # files of earlier runs that are still valid are not downloaded again
+        results = {}
+        for job_request, job_name in jobs:
+            fname = os.path.join(outdir, job_name)
+            if args.incremental and valid_file(job_request, fname, manifest.get(job_name)):
+                results[job_name] = {'date': job_request['date_min'], 'file': job_name, 'state': 'valid',
+                                     'bytes': os.path.getsize(fname), 'seconds': 0., 'message': 'Already complete'}
+                if job_name not in manifest:
+                    manifest[job_name] = manifest_entry(job_request, fname)
+            else:
+                manifest.pop(job_name, None)
+        logging.info('%i of %i files already complete'%(len(results), len(jobs)))
+
+        # all extractions are queued on the server together and each is
+        # downloaded as soon as it is ready. The manifest is updated as each
+        # download completes, so that a crashed run resumes where it stopped
+        todo = [(job_request, job_name) for job_request, job_name in jobs if job_name not in results]
+
+        def job_done(ii, size, error, seconds):
+            job_request, job_name = todo[ii]
+            results[job_name] = job_result(job_request, job_name, size, error, seconds, logging)
+            if error is None:
+                manifest[job_name] = manifest_entry(job_request, os.path.join(outdir, job_name))
+                write_manifest(manifest, manifest_file)
+
+        client.fetch_batch([(job_request, os.path.join(outdir, job_name)) for job_request, job_name in todo],
+                           job_done, workers=max(args.workers,1), max_queued=max(args.queued,1))
+        write_manifest(manifest, manifest_file)
+        results = [results[job_name] for job_request, job_name in jobs]
+    finally:
+        client.close()
+
+    # merge the pieces; they are kept if any is missing or the merge fails
+    if args.plan and all([result['state'] in ('downloaded','valid') for result in results]):
+        try:
+            size = merge_netcdf([os.path.join(outdir, job_name) for job_request, job_name in jobs],
+                                os.path.join(outdir, outname), logging)
+            shutil.rmtree(part_dir)
+            for job_request, job_name in jobs:
+                manifest.pop(job_name, None)
+            manifest[outname] = manifest_entry(request, os.path.join(outdir, outname))
+            write_manifest(manifest, manifest_file)
+            logging.info('Merged %i pieces into %s (%i bytes)'%(len(jobs), outname, size))
+            print('Merged %i pieces into %s'%(len(jobs), os.path.join(outdir, outname)))
+        except Exception as err:
+            logging.error('Merge into '+outname+' failed: '+str(err))
+            print('FAILED merge into '+outname+': '+str(err))
+
+    # report
+    results_file = logfile.replace('.log','_results.csv')
+    write_results(results, results_file)
+    n_ok    = len([result for result in results if result['state'] == 'downloaded'])
+    n_valid = len([result for result in results if result['state'] == 'valid'])
+    logging.info('%i of %i files downloaded, %i already complete, results in %s'%(n_ok, len(results), n_valid, results_file))
+    print('%i of %i files downloaded, %i already complete, results in %s'%(n_ok, len(results), n_valid, results_file))
+    for result in results:
+        if result['state'] not in ('downloaded','valid'):
+            print('FAILED '+result['file']+': '+result['message'])
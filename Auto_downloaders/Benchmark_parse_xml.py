@@ -0,0 +1,144 @@
+'''
+    Purpose:    Micro-benchmark of the OpenSearch feed parser used by Universal_Sentinel_Downloader
+    Version:    v1.0 10/2026
+    Notes:      This code is offered with no warranty and under the MIT licence.
+
+    Times the streaming parser (parse_xml) against the original regex + full tree +
+    per-entry XPath parser on synthetic feeds of 100, 1,000 and 10,000 entries.
+    The footprint coverage of a few known cases is checked first.
+
+    Usage:
+    /opt/local/bin/python3.6 Benchmark_parse_xml.py -n 100,1000,10000 -r 5
+
+'''
+
+import re
+import sys
+import time
+import optparse
+from lxml import etree
+
+from Universal_Sentinel_Downloader import parse_xml, footprint_coverage
+
+# ------------------------------------------------------------------------------
+ENTRY_TEMPLATE = \
+'''<entry>
+<title>%(identifier)s</title>
+<link href="https://coda.eumetsat.int/odata/v1/Products('%(uuid)s')/$value"/>
+<link rel="alternative" href="https://coda.eumetsat.int/odata/v1/Products('%(uuid)s')/"/>
+<link rel="icon" href="https://coda.eumetsat.int/odata/v1/Products('%(uuid)s')/Products('Quicklook')/$value"/>
+<id>%(uuid)s</id>
+<summary>Date: 2018-10-01T10:10:10.000Z, Instrument: OLCI, Mode: , Satellite: Sentinel-3, Size: 312.54 MB</summary>
+<date name="ingestiondate">2018-10-02T12:00:00.000Z</date>
+<date name="beginposition">2018-10-01T10:10:10.000Z</date>
+<date name="endposition">2018-10-01T10:13:10.000Z</date>
+<int name="orbitnumber">13542</int>
+<int name="relativeorbitnumber">236</int>
+<str name="footprint">POLYGON ((-11.0 49.5,-8.0 49.5,-8.0 52.0,-11.0 52.0,-11.0 49.5))</str>
+<str name="format">SAFE</str>
+<str name="identifier">%(identifier)s</str>
+<str name="instrumentname">Ocean Land Colour Instrument</str>
+<str name="platformname">Sentinel-3</str>
+<str name="producttype">OL_2_WFR___</str>
+<str name="timeliness">Non Time Critical</str>
+<str name="size">312.54 MB</str>
+<str name="filename">%(identifier)s.SEN3</str>
+<str name="uuid">%(uuid)s</str>
+</entry>
+'''
+
+# (footprint, box, expected coverage) checked before timing: a plain
+# footprint, and one across the antimeridian seen from either side
+COVERAGE_CHECKS = [
+    ('POLYGON ((-11.0 49.5,-8.0 49.5,-8.0 52.0,-11.0 52.0,-11.0 49.5))', (-10.,50.,-6.,51.), 0.5),
+    ('POLYGON ((170 49.5,-170 49.5,-170 51.5,170 51.5,170 49.5))', (175.,50.,179.,51.), 1.0),
+    ('POLYGON ((170 49.5,-170 49.5,-170 51.5,170 51.5,170 49.5))', (-179.,50.,-175.,51.), 1.0),
+    ]
+
+# ------------------------------------------------------------------------------
+def make_feed(n_entries):
+    # synthetic search feed with n_entries entries
+    entries = []
+    for ii in range(n_entries):
+        entries.append(ENTRY_TEMPLATE%{'uuid': '%08x-0000-4000-8000-%012x'%(ii,ii),
+                                       'identifier': 'S3A_OL_2_WFR____20181001T101010_20181001T101310_'
+                                                     '20181002T120000_0179_036_%03i_2160_MAR_O_NT_002'%(ii%1000)})
+
+    feed = '<?xml version="1.0" encoding="utf-8"?>\n'\
+           '<feed xmlns:opensearch="http://a9.com/-/spec/opensearch/1.1/" xmlns="http://www.w3.org/2005/Atom">\n'\
+           '<title>Sentinels Scientific Data Hub search results</title>\n'\
+           '<opensearch:totalResults>%i</opensearch:totalResults>\n'\
+           '<opensearch:startIndex>0</opensearch:startIndex>\n'\
+           '<opensearch:itemsPerPage>%i</opensearch:itemsPerPage>\n'%(n_entries,n_entries)
+    feed += ''.join(entries) + '</feed>\n'
+
+    return feed.encode('utf-8')
+
+# ------------------------------------------------------------------------------
+def legacy_parse_xml(xml_text):
+    # the original parser, kept here as the reference
+    if sys.version_info[0] == 3:
+        xml_str = re.sub(b' xmlns="[^"]+"', b'', xml_text, count=1)
+    else:
+        xml_str = re.sub(' xmlns="[^"]+"', '', xml_text, count=1)
+
+    root = etree.fromstring(xml_str)
+    entry_list = root.xpath("//entry")
+
+    res = []
+    for ee in entry_list:
+        dt = {
+              'uuid': ee.xpath("str[@name='uuid']/text()")[0],
+              'identifier': ee.xpath("str[@name='identifier']/text()")[0],
+              'beginposition': ee.xpath("date[@name='beginposition']/text()")[0],
+              'endposition': ee.xpath("date[@name='endposition']/text()")[0],
+             }
+        res.append(dt)
+
+    return res
+
+# ------------------------------------------------------------------------------
+def best_time(func,xml_text,repeats):
+    # best wall clock time of repeats calls
+    best = None
+    for ii in range(repeats):
+        t0 = time.time()
+        func(xml_text)
+        elapsed = time.time() - t0
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+# ======================================================================
+if __name__=="__main__":
+
+    command_line_parser = optparse.OptionParser()
+
+    command_line_parser.add_option("--entries", "-n", dest="entries", default = '100,1000,10000',
+                                  help="Comma separated feed sizes (number of entries)")
+
+    command_line_parser.add_option("--repeats", "-r", dest="repeats", default = 5, type="int",
+                                  help="Number of timed repeats (best is reported)")
+
+    options,arguments = command_line_parser.parse_args()
+
+    for wkt,box,expected in COVERAGE_CHECKS:
+        if abs(footprint_coverage(wkt,box) - expected) > 1.e-9:
+            raise Exception("Wrong coverage of %s by %s!"%(str(box),wkt))
+
+    print('%10s %14s %14s %10s'%('entries','legacy [ms]','streaming [ms]','speedup'))
+    for n_entries in [int(nn) for nn in options.entries.split(',')]:
+        xml_text = make_feed(n_entries)
+
+        # both parsers must agree before we time them
+        entries,total = parse_xml(xml_text)
+        legacy        = legacy_parse_xml(xml_text)
+        if total != n_entries or [ee['uuid'] for ee in entries] != [ee['uuid'] for ee in legacy]:
+            raise Exception("Parsers disagree on the %i entry feed!"%n_entries)
+
+        t_legacy = best_time(legacy_parse_xml,xml_text,options.repeats)
+        t_stream = best_time(parse_xml,xml_text,options.repeats)
+        print('%10i %14.2f %14.2f %9.1fx'%(n_entries,t_legacy*1000.,t_stream*1000.,t_legacy/t_stream))
+
+#-EOF
@@ -0,0 +1,297 @@
+'''
+    Purpose:    Rewrite an archive of Sentinel-3 SEN3 products into tiled, compressed stores
+    Version:    v1.0 10/2026
+    Notes:      This code is offered with no warranty and under the MIT licence.
+
+    The NetCDF files of a SEN3 product (measurement files such as chl_nn.nc,
+    geo_coordinates.nc, the flag files, ...) are chunked for the way they
+    are produced, not for the way we read them: reading a small window of
+    CHL_NN or WQSF means decompressing much more of the scene than the
+    window. This script rewrites every variable of every product found under
+    an archive (e.g. the one filled by Universal_Sentinel_Downloader.py) in
+    square tiles of --chunk pixels, compressed, with the same names, types,
+    attributes (scale_factor, add_offset, _FillValue, flag_masks, ...) and
+    dimensions. With the default NetCDF4 format the converted products can
+    be read exactly as the originals; with --format zarr every file becomes
+    a Zarr store in Zarr format 2 (needs the zarr package: zarr 2, or zarr 3
+    on Python 3.11 or later).
+
+    Products are converted in parallel (--workers processes), each into a
+    temporary directory that is renamed when it is complete, so converted
+    products are skipped when the conversion is run again.
+
+    Usage:
+    /opt/local/bin/python3 Convert_SEN3_archive.py -i ./Data/store -o ./Data/tiled -c 256,256 -w 8
+
+'''
+
+import os
+import sys
+import time
+import shutil
+import fnmatch
+import logging
+import optparse
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from netCDF4 import Dataset, VLType
+
+try:
+    import zarr
+    import numcodecs
+    # zarr 3 changed the API used to create arrays
+    ZARR_3 = int(zarr.__version__.split('.')[0]) >= 3
+except ImportError:
+    zarr = None
+
+# largest block of a variable held in memory while copying it, in bytes
+COPY_BLOCK = 64*1024*1024
+
+# ------------------------------------------------------------------------------
+def find_products(input_dir):
+    # all the SEN3 product directories under input_dir
+    products = []
+    for root, dirnames, filenames in os.walk(input_dir):
+        for dirname in sorted(dirnames):
+            if dirname.endswith('.SEN3'):
+                products.append(os.path.join(root, dirname))
+        # do not look inside products
+        dirnames[:] = [dirname for dirname in dirnames if not dirname.endswith('.SEN3')]
+
+    return sorted(products)
+
+# ------------------------------------------------------------------------------
+def chunk_shape(shape, chunk):
+    # tile shape of a variable: chunk[0] x chunk[1] over the last two
+    # (row, column) dimensions, one step along any others
+    if len(shape) == 0:
+        return None
+    if len(shape) == 1:
+        return [max(min(shape[0], chunk[0]*chunk[1]), 1)]
+
+    chunks = [1]*(len(shape)-2) + [min(shape[-2], chunk[0]), min(shape[-1], chunk[1])]
+
+    return [max(cc, 1) for cc in chunks]
+
+# ------------------------------------------------------------------------------
+def copy_blocks(src_var, dst_var, chunks):
+    # copy a variable in blocks of whole tiles along its first dimension;
+    # scalars and variable length (string) variables in one go
+    if len(src_var.shape) == 0 or src_var.dtype == str or isinstance(getattr(src_var, 'datatype', None), VLType):
+        dst_var[...] = src_var[...]
+        return
+    if src_var.shape[0] == 0:
+        return
+
+    row_bytes = src_var.dtype.itemsize * int(np.prod(src_var.shape[1:]))
+    step = chunks[0] * max(int(COPY_BLOCK // max(row_bytes*chunks[0], 1)), 1)
+    for i0 in range(0, src_var.shape[0], step):
+        i1 = min(i0+step, src_var.shape[0])
+        dst_var[i0:i1] = src_var[i0:i1]
+
+    return
+
+# ------------------------------------------------------------------------------
+def convert_netcdf(src_fname, dst_fname, par):
+    # rewrite a NetCDF file as tiled, compressed NetCDF4; packed values are
+    # copied as they are, so scale, offset and fill value still apply
+    with Dataset(src_fname) as src, Dataset(dst_fname, 'w', format='NETCDF4') as dst:
+        src.set_auto_maskandscale(False)
+        dst.set_auto_maskandscale(False)
+        dst.setncatts(dict((att, src.getncattr(att)) for att in src.ncattrs()))
+        for name, dim in src.dimensions.items():
+            dst.createDimension(name, None if dim.isunlimited() else len(dim))
+
+        for name, var in src.variables.items():
+            chunks = chunk_shape(var.shape, par['chunk'])
+            kwargs = {'fill_value': getattr(var, '_FillValue', None)}
+            if chunks is not None and var.dtype != str:
+                kwargs.update(zlib=True, complevel=par['complevel'], shuffle=True, chunksizes=chunks)
+            out_var = dst.createVariable(name, var.dtype, var.dimensions, **kwargs)
+            out_var.set_auto_maskandscale(False)
+            out_var.setncatts(dict((att, var.getncattr(att)) for att in var.ncattrs() if att != '_FillValue'))
+            copy_blocks(var, out_var, chunks)
+
+    return
+
+# ------------------------------------------------------------------------------
+def zarr_attribute(value):
+    # a NetCDF attribute as a JSON friendly value
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+
+    return value
+
+# ------------------------------------------------------------------------------
+def convert_zarr(src_fname, dst_dir, par):
+    # rewrite a NetCDF file as a Zarr store, one array per variable; the
+    # dimension names are kept (as xarray does) in _ARRAY_DIMENSIONS
+    if zarr is None:
+        raise Exception("The zarr package is needed for --format zarr")
+
+    compressor = numcodecs.Blosc(cname='zstd', clevel=par['complevel'], shuffle=numcodecs.Blosc.SHUFFLE)
+    with Dataset(src_fname) as src:
+        src.set_auto_maskandscale(False)
+        if ZARR_3:
+            group = zarr.open_group(dst_dir, mode='w', zarr_format=2)
+        else:
+            group = zarr.open_group(dst_dir, mode='w')
+        group.attrs.update(dict((att, zarr_attribute(src.getncattr(att))) for att in src.ncattrs()))
+
+        for name, var in src.variables.items():
+            chunks = chunk_shape(var.shape, par['chunk'])
+            fill   = getattr(var, '_FillValue', None)
+            fill   = None if fill is None else zarr_attribute(fill)
+            if ZARR_3:
+                out_var = group.create_array(name, shape=var.shape, chunks=chunks or (), dtype=var.dtype,
+                                             compressors=compressor, fill_value=fill)
+            elif var.dtype == str:
+                out_var = group.create_dataset(name, shape=var.shape, chunks=chunks or True, dtype=object,
+                                               object_codec=numcodecs.VLenUTF8(), compressor=compressor,
+                                               fill_value=fill)
+            else:
+                out_var = group.create_dataset(name, shape=var.shape, chunks=chunks or True, dtype=var.dtype,
+                                               compressor=compressor, fill_value=fill)
+            attrs = dict((att, zarr_attribute(var.getncattr(att))) for att in var.ncattrs() if att != '_FillValue')
+            attrs['_ARRAY_DIMENSIONS'] = list(var.dimensions)
+            out_var.attrs.update(attrs)
+            copy_blocks(var, out_var, chunks)
+
+    return
+
+# ------------------------------------------------------------------------------
+def convert_product(product_dir, par):
+    # convert one product into the mirrored place under the output
+    # directory; returns (product, state, input bytes, output bytes, seconds)
+    rel_path = os.path.relpath(product_dir, par['input_dir'])
+    out_dir  = os.path.join(par['output_dir'], rel_path)
+    if os.path.exists(out_dir) and not par['force']:
+        return product_dir, 'skipped', 0, 0, 0.
+
+    t0 = time.time()
+    tmp_dir = os.path.join(os.path.dirname(out_dir), '.'+os.path.basename(out_dir)+'.convert')
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+
+    in_bytes = 0
+    for root, dirnames, filenames in os.walk(product_dir):
+        dest = os.path.join(tmp_dir, os.path.relpath(root, product_dir))
+        os.makedirs(dest, exist_ok=True)
+        for filename in filenames:
+            src_fname = os.path.join(root, filename)
+            in_bytes  = in_bytes + os.path.getsize(src_fname)
+            if not any([fnmatch.fnmatch(filename, pattern) for pattern in par['files']]):
+                shutil.copy2(src_fname, dest)
+            elif par['format'] == 'zarr':
+                convert_zarr(src_fname, os.path.join(dest, os.path.splitext(filename)[0]+'.zarr'), par)
+            else:
+                convert_netcdf(src_fname, os.path.join(dest, filename), par)
+
+    out_bytes = 0
+    for root, dirnames, filenames in os.walk(tmp_dir):
+        out_bytes = out_bytes + sum([os.path.getsize(os.path.join(root, filename)) for filename in filenames])
+
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    os.replace(tmp_dir, out_dir)
+
+    return product_dir, 'converted', in_bytes, out_bytes, time.time() - t0
+
+# ------------------------------------------------------------------------------
+def convert_archive(par, logging):
+    # convert every product of the archive, par['workers'] at a time
+    products = find_products(par['input_dir'])
+    logging.info('%i products under %s'%(len(products), par['input_dir']))
+
+    results = []
+    with ProcessPoolExecutor(max_workers=par['workers']) as pool:
+        futures = dict([(pool.submit(convert_product, product_dir, par), product_dir) for product_dir in products])
+        for future in as_completed(futures):
+            try:
+                product_dir, state, in_bytes, out_bytes, seconds = future.result()
+            except Exception as err:
+                product_dir, state, in_bytes, out_bytes, seconds = futures[future], 'failed', 0, 0, 0.
+                logging.error('Conversion of %s failed: %s'%(futures[future], err))
+            if state == 'converted':
+                logging.info('Converted %s in %.1f s (%.1f MB -> %.1f MB)'%\
+                             (os.path.basename(product_dir), seconds, in_bytes/1.e6, out_bytes/1.e6))
+            results.append(state)
+
+    return results
+
+# ======================================================================
+if __name__=="__main__":
+
+    command_line_parser = optparse.OptionParser()
+
+    command_line_parser.add_option("--input_dir", "-i", dest="input_dir", default = './Data',
+                                  help="Archive searched for SEN3 products")
+
+    command_line_parser.add_option("--output_dir", "-o", dest="output_dir", default = './Data_tiled',
+                                  help="Root of the converted archive (same layout as the input)")
+
+    command_line_parser.add_option("--chunk", "-c", dest="chunk", default = '256,256',
+                                  help="Tile shape in rows,columns (match the windows you read)")
+
+    command_line_parser.add_option("--complevel", dest="complevel", default = 4, type="int",
+                                  help="Compression level (1-9)")
+
+    command_line_parser.add_option("--format", "-f", dest="format", default = 'netcdf', choices=['netcdf','zarr'],
+                                  help="Output format: netcdf (NetCDF4) or zarr")
+
+    command_line_parser.add_option("--files", dest="files", default = '*.nc',
+                                  help="Comma separated patterns of the files to convert (others are copied)")
+
+    command_line_parser.add_option("--workers", "-w", dest="workers", default = 0, type="int",
+                                  help="Number of products converted at the same time (default: number of cores)")
+
+    command_line_parser.add_option("--force", dest="force", action="store_true", default=False,
+                                  help="Convert products that were already converted")
+
+    command_line_parser.add_option("--logfile", "-z", dest="logfile", default = 'Convert_SEN3_log',
+                                  help="Log file")
+
+    options,arguments = command_line_parser.parse_args()
+
+#-------------------------------------------------------------------------------
+#-main----
+if __name__ == "__main__":
+    logfile = options.logfile+"_"+datetime.now().strftime('%Y%m%d_%H%M%S')+".log"
+
+    # set file logger
+    try:
+        if os.path.exists(logfile):
+            os.remove(logfile)
+        logging.basicConfig(filename=logfile,level=logging.INFO)
+        print("Logging to: "+logfile)
+    except:
+        raise Exception("Failed to set logger")
+
+    par = {'input_dir':  os.path.abspath(options.input_dir),
+           'output_dir': os.path.abspath(options.output_dir),
+           'chunk':      [int(cc) for cc in options.chunk.split(',')],
+           'complevel':  options.complevel,
+           'format':     options.format,
+           'files':      options.files.split(','),
+           'workers':    options.workers if options.workers > 0 else (os.cpu_count() or 1),
+           'force':      options.force}
+    if len(par['chunk']) != 2:
+        raise Exception("--chunk must be rows,columns")
+    if par['format'] == 'zarr' and zarr is None:
+        raise Exception("The zarr package is needed for --format zarr")
+
+    results = convert_archive(par, logging)
+
+    n_done = len([res for res in results if res == 'converted'])
+    n_skip = len([res for res in results if res == 'skipped'])
+    logging.info('%i products converted, %i already converted, %i failed'%\
+                 (n_done, n_skip, len(results)-n_done-n_skip))
+    print('%i products converted, %i already converted, %i failed'%(n_done, n_skip, len(results)-n_done-n_skip))
+    if n_done + n_skip < len(results):
+        sys.exit(1)
+
+#-EOF
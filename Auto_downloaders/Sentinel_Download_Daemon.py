@@ -0,0 +1,303 @@
+'''
+    Purpose:    Long running, multi-subscription downloader for Sentinel data
+    Version:    v1.0 10/2026
+    Notes:      This code is offered with no warranty and under the MIT licence.
+
+    Replaces many cron'd copies of Universal_Sentinel_Downloader.py (one per footprint and
+    product type) with one process. Each subscription in the config file is queried on its
+    own interval. The results of all subscriptions that are due are merged, so that a
+    product wanted by several subscriptions is downloaded once into a shared store and then
+    linked into every subscriber's archive. Products are downloaded with the download
+    options (--members, --segments, --priority, ...) of the subscriptions that want them.
+    One connection pool, and the hubs' ranking and circuit breakers, are kept per hub for
+    the life of the daemon.
+
+    See Sentinel_subscriptions.cfg for an example config file.
+
+    Usage:
+    /opt/local/bin/python3.6 Sentinel_Download_Daemon.py -c Sentinel_subscriptions.cfg
+
+'''
+
+import os
+import sys
+import time
+import shlex
+import logging
+import optparse
+from datetime import datetime
+from collections import OrderedDict
+
+try:
+    import configparser
+except ImportError:
+    import ConfigParser as configparser
+
+import Universal_Sentinel_Downloader as usd
+
+# downloader parameters that change how (not which) products are downloaded
+DOWNLOAD_OPTIONS = ('url','Retries','Backoff_factor','Timeout','Concurrency','Hub_connections',
+                    'Resume_retries','Segments','Segment_min_size','Buffer_size','Verify_checksum',
+                    'Checksum_retries','Members','Member_concurrency','Extract','Extract_members',
+                    'Priority','Max_rate','rate_file')
+
+# ------------------------------------------------------------------------------
+def read_subscriptions(cfg_file):
+    # read the [daemon] settings and one subscription per other section
+    config = configparser.ConfigParser(interpolation=None, inline_comment_prefixes=('#',))
+    if len(config.read(cfg_file)) == 0:
+        raise Exception("Cannot read subscriptions file: "+cfg_file)
+
+    daemon = dict(config.items('daemon'))
+    subs   = []
+    for name in config.sections():
+        if name == 'daemon':
+            continue
+        sub = dict(config.items(name))
+        sub['name']     = name
+        sub['interval'] = float(sub.get('interval','60'))
+        subs.append(sub)
+
+    if len(subs) == 0:
+        raise Exception("No subscriptions in "+cfg_file)
+
+    return daemon,subs
+
+# ------------------------------------------------------------------------------
+def subscription_par(daemon,sub):
+    # build the downloader parameters of a subscription by going through the
+    # downloader's own command line options
+    argv = ['--user', daemon['user'], '--pass', daemon['pass'],
+            '--url', sub.get('url', daemon.get('url','https://coda.eumetsat.int')),
+            '--fprint', sub['footprint'],
+            '--plat', sub.get('platform','Sentinel-3'),
+            '--prod', sub.get('producttype','OL_2_WFR*'),
+            '--date_from', sub.get('date_from','NOW-1'),
+            '--date_to', sub.get('date_to','NOW'),
+            '--dir', sub['root_dir'],
+            '--concurrency', daemon.get('concurrency','1')]
+    if sub.get('make_subdir','true').lower() in ('true','yes','1'):
+        argv.append('--make_subdir')
+    argv += shlex.split(daemon.get('options','')) + shlex.split(sub.get('options',''))
+
+    options,arguments = usd.build_command_line_parser().parse_args(argv)
+    par = usd.parse_options(options)
+
+    return par
+
+# ------------------------------------------------------------------------------
+def cycle_par(daemon,sub,catalog,pools,metrics):
+    # the parameters of a subscription for this cycle: built afresh every
+    # time, so that NOW and NOW-x dates move on with the daemon. Only the
+    # shared catalog and the hubs' state are carried over; query results are
+    # not filtered by the catalog, so that archived products still get
+    # linked into new subscribers' archives. All subscriptions of a cycle
+    # record into its metrics.
+    par = subscription_par(daemon,sub)
+    par['catalog']       = catalog
+    par['Skip_archived'] = False
+    par['metrics']       = metrics
+    par['_hub_pool']     = hub_state(pools,par)
+
+    return par
+
+# ------------------------------------------------------------------------------
+def download_options(par):
+    # the download options of a subscription, comparable between subscriptions
+    return tuple([str(par[key]) for key in DOWNLOAD_OPTIONS])
+
+# ------------------------------------------------------------------------------
+def hub_session(sessions,par):
+    # one pooled session per hub, kept for the life of the daemon
+    if par['url'] not in sessions:
+        sessions[par['url']] = usd.open_session(par)
+
+    return sessions[par['url']]
+
+# ------------------------------------------------------------------------------
+def hub_state(pools,par):
+    # one HubPool (latency ranking and circuit breakers) per list of hubs,
+    # kept for the life of the daemon, so that a hub resting after failures
+    # is not tried again at full rate by the next cycle
+    if par['url'] not in pools:
+        pools[par['url']] = usd.HubPool(par['url'].split(','),par['Fail_threshold'],par['Hub_cooldown'])
+
+    return pools[par['url']]
+
+# ------------------------------------------------------------------------------
+def link_product(src,sub_par,ee,logging):
+    # make an archived product appear in a subscriber's archive: hard link if
+    # we can, symbolic link otherwise (other file system, or a directory)
+    arc_dir = usd.archive_dir(sub_par,ee,logging)
+    if arc_dir is None:
+        return
+
+    dest = os.path.join(arc_dir,os.path.basename(src))
+    if os.path.lexists(dest):
+        return
+
+    if not os.path.exists(arc_dir):
+        os.makedirs(arc_dir)
+
+    try:
+        os.link(src,dest)
+    except OSError:
+        os.symlink(os.path.abspath(src),dest)
+    logging.info('Linked '+os.path.basename(src)+' into '+arc_dir)
+
+    return
+
+# ------------------------------------------------------------------------------
+def run_cycle(daemon,due,catalog,sessions,pools,logging):
+    # one cycle, with metrics of its own that are written out at its end
+    metrics = usd.RunMetrics()
+    try:
+        fetch_cycle(daemon,due,catalog,sessions,pools,metrics,logging)
+    finally:
+        usd.write_metrics({'metrics': metrics,
+                           'hub': ','.join(sorted(set([sub['par']['url'] for sub in due if 'par' in sub]))),
+                           'metrics_json': daemon.get('metrics_json',''),
+                           'prom_file': daemon.get('prom_file','')},logging)
+
+    return
+
+# ------------------------------------------------------------------------------
+def fetch_cycle(daemon,due,catalog,sessions,pools,metrics,logging):
+    # query every due subscription, merge the results, download each product
+    # once into the store and link it into every subscriber's archive
+    merged = OrderedDict()
+    for sub in due:
+        sub['par'] = cycle_par(daemon,sub,catalog,pools,metrics)
+        par = sub['par']
+        if par['incremental']:
+            par = usd.apply_watermark(par,logging)
+
+        logging.info('Querying subscription: '+sub['name'])
+        n_found = 0
+        for ee in usd.process_request(par,logging,req_ses=hub_session(sessions,par)):
+            # (uuids differ from hub to hub: a product is known by its name)
+            key = ee['identifier']
+            if key not in merged:
+                merged[key] = {'entry': ee, 'subs': [], 'options': download_options(par)}
+            elif merged[key]['options'] != download_options(par):
+                logging.warning('%s is also wanted by %s, with other download options: downloaded with those of %s'\
+                                %(key,sub['name'],merged[key]['subs'][0]['name']))
+            merged[key]['subs'].append(sub)
+            n_found = n_found + 1
+        if par['_query_complete']:
+            logging.info('%s: %i products'%(sub['name'],n_found))
+        else:
+            logging.error('%s: query incomplete, only %i products (of %s) fetched'\
+                          %(sub['name'],n_found,'?' if par['total_results'] is None else str(par['total_results'])))
+
+    logging.info('%i distinct products for %i subscriptions'%(len(merged),len(due)))
+
+    # download the products wanted with the same download options (hubs
+    # included) together
+    groups = OrderedDict()
+    for identifier,item in merged.items():
+        groups.setdefault(item['options'],[]).append(item)
+
+    per_sub = {}
+    for options,items in groups.items():
+        # download parameters: those of the first subscription wanting these
+        # products, with the archive moved to the shared store
+        store_par = dict(items[0]['subs'][0]['par'])
+        store_par['req']          = dict(store_par['req'])
+        store_par['root_dir']     = daemon['store']
+        store_par['make_sub_dir'] = True
+        store_par['catalog']      = catalog
+
+        results = usd.download_files(store_par,[item['entry'] for item in items],logging,
+                                     req_ses=hub_session(sessions,store_par))
+
+        for item,res in zip(items,results):
+            for sub in item['subs']:
+                per_sub.setdefault(sub['name'],[]).append(res)
+            if res['state'] not in ('downloaded','archived'):
+                continue
+            rec = catalog.lookup(item['entry']['identifier'])
+            if rec is None or rec['path'] is None or not os.path.exists(rec['path']):
+                continue
+            for sub in item['subs']:
+                link_product(rec['path'],sub['par'],item['entry'],logging)
+
+    for sub in due:
+        if sub['par']['incremental']:
+            usd.update_watermark(sub['par'],per_sub.get(sub['name'],[]),logging)
+
+    return
+
+# ======================================================================
+if __name__=="__main__":
+
+    command_line_parser = optparse.OptionParser()
+
+    command_line_parser.add_option("--config", "-c", dest="config_file", default = 'Sentinel_subscriptions.cfg',
+                                  help="Subscriptions file")
+
+    command_line_parser.add_option("--logfile", "-z", dest="logfile", default = 'Download_daemon_log',
+                                  help="Log file")
+
+    command_line_parser.add_option("--once", dest="once", action="store_true", default=False,
+                                  help="Run every subscription once and exit")
+
+    options,arguments = command_line_parser.parse_args()
+
+#-------------------------------------------------------------------------------
+#-main----
+if __name__ == "__main__":
+    logfile = options.logfile+"_"+datetime.now().strftime('%Y%m%d_%H%M%S')+".log"
+
+    # set file logger
+    try:
+        if os.path.exists(logfile):
+            os.remove(logfile)
+        logging.basicConfig(filename=logfile,level=logging.INFO)
+        print("Logging to: "+logfile)
+    except:
+        raise Exception("Failed to set logger")
+
+    daemon,subs = read_subscriptions(options.config_file)
+    # fail now on a bad subscription, not at its first cycle
+    for sub in subs:
+        subscription_par(daemon,sub)
+
+    # one catalog, in the shared store, for all subscriptions
+    if not os.path.exists(daemon['store']):
+        os.makedirs(daemon['store'])
+    catalog = usd.ProductCatalog(os.path.join(daemon['store'],'.product_catalog.db'))
+
+    sessions = {}
+    pools    = {}
+    next_run = dict([(sub['name'],0.) for sub in subs])
+    poll     = float(daemon.get('poll','60'))
+
+    logging.info('Started with %i subscriptions'%len(subs))
+    try:
+        while True:
+            now = time.time()
+            due = [sub for sub in subs if next_run[sub['name']] <= now]
+            if len(due) > 0:
+                try:
+                    run_cycle(daemon,due,catalog,sessions,pools,logging)
+                except Exception as err:
+                    # keep the daemon alive, try again at the next interval
+                    logging.error('Cycle failed: '+str(err))
+                for sub in due:
+                    next_run[sub['name']] = now + sub['interval']*60.
+
+            if options.once:
+                break
+
+            time.sleep(min(max(min(next_run.values()) - time.time(), 1.), poll))
+    except KeyboardInterrupt:
+        logging.info('Interrupted')
+    finally:
+        for req_ses in sessions.values():
+            req_ses.close()
+        catalog.close()
+
+    logging.info("Done")
+
+#-EOF
@@ -15,204 +15,1703 @@
 
 import logging
 import re
+import io
+import json
+import hashlib
+import heapq
+import sqlite3
+import zipfile
 import requests
+import urllib3
 from lxml import etree
 import os
 from datetime import datetime, timedelta
 from glob import glob
+from fnmatch import fnmatch
 import tempfile
 import optparse
 import sys, os, shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 
 # ------------------------------------------------------------------------------
-def Define_request(par,url_hub):
-    # Define search request and set par['hub']
+class ProductCatalog(object):
+    # on-disk (SQLite) catalog of the products we hold, keyed by identifier
+    # (uuids are hub specific), recording the archive path, byte size,
+    # checksum and download state. One connection is shared by all download
+    # workers, so every access goes through the lock.
+
+    def __init__(self,db_fname):
+        self.db_fname = db_fname
+        self.lock     = threading.Lock()
+        self.db       = sqlite3.connect(db_fname, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS products ("
+                            "identifier TEXT PRIMARY KEY, uuid TEXT, path TEXT, "
+                            "size INTEGER, checksum TEXT, state TEXT, updated TEXT)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS products_uuid ON products (uuid)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS watermarks ("
+                            "query TEXT PRIMARY KEY, ingestiondate TEXT, updated TEXT)")
+
+    def lookup(self,identifier):
+        # return the catalog record of a product as a dict (None if unknown)
+        with self.lock:
+            row = self.db.execute("SELECT identifier, uuid, path, size, checksum, state "
+                                  "FROM products WHERE identifier=?", (identifier,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(['identifier','uuid','path','size','checksum','state'],row))
+
+    def is_archived(self,identifier):
+        # True if the product is recorded as archived and is still on disk
+        rec = self.lookup(identifier)
+        if rec is None or rec['state'] != 'archived' or not os.path.exists(rec['path']):
+            return False
+        if os.path.isfile(rec['path']) and rec['size'] is not None:
+            return os.path.getsize(rec['path']) == rec['size']
+        return True
+
+    def record(self,identifier,state,uuid=None,path=None,size=None,checksum=None):
+        # insert or update a product; fields left as None keep their old value
+        with self.lock, self.db:
+            self.db.execute("INSERT OR IGNORE INTO products (identifier) VALUES (?)", (identifier,))
+            self.db.execute("UPDATE products SET state=?, updated=?, "
+                            "uuid=COALESCE(?,uuid), path=COALESCE(?,path), "
+                            "size=COALESCE(?,size), checksum=COALESCE(?,checksum) "
+                            "WHERE identifier=?",
+                            (state, datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S'),
+                             uuid, path, size, checksum, identifier))
+
+    def get_watermark(self,query):
+        # last ingestion date harvested for a query (None if never run)
+        with self.lock:
+            row = self.db.execute("SELECT ingestiondate FROM watermarks WHERE query=?", (query,)).fetchone()
+        return None if row is None else row[0]
+
+    def set_watermark(self,query,ingestiondate):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO watermarks (query, ingestiondate, updated) VALUES (?,?,?)",
+                            (query, ingestiondate, datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S')))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+# ------------------------------------------------------------------------------
+class RunMetrics(object):
+    # performance records of one run: one record per query page and per
+    # product, plus running totals. Shared by all download workers, so every
+    # update goes through the lock. Written out at the end of the run as JSON
+    # lines and/or a Prometheus textfile-collector file.
+
+    COUNTERS = ['queries','query_seconds','parse_seconds','entries',
+                'ttfb_count','ttfb_seconds','download_seconds',
+                'bytes_transferred','bytes_skipped','retries']
+    STATES   = ['downloaded','failed','archived','skipped']
+
+    def __init__(self):
+        self.lock     = threading.Lock()
+        self.started  = time.time()
+        self.records  = []
+        self.totals   = dict([(kk,0) for kk in self.COUNTERS])
+        self.products = dict([(kk,0) for kk in self.STATES])
+
+    def add(self,**increments):
+        with self.lock:
+            for kk,vv in increments.items():
+                self.totals[kk] += vv
+
+    def record(self,kind,**fields):
+        fields['record'] = kind
+        fields['time']   = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+        with self.lock:
+            self.records.append(fields)
+
+    def query(self,url_str,status_code,latency,parse_time,n_entries):
+        self.add(queries=1,query_seconds=latency,parse_seconds=parse_time,entries=n_entries)
+        self.record('query',url=url_str,status_code=status_code,latency_s=round(latency,6),
+                    parse_s=round(parse_time,6),entries=n_entries)
+
+    def first_byte(self,ttfb):
+        self.add(ttfb_count=1,ttfb_seconds=ttfb)
+
+    def product(self,status):
+        seconds = status.get('seconds',0.)
+        with self.lock:
+            self.products[status['state']] = self.products.get(status['state'],0) + 1
+            self.totals['download_seconds'] += seconds
+            self.totals['bytes_transferred'] += status.get('bytes_transferred',0)
+            self.totals['bytes_skipped']    += status.get('bytes_skipped',0)
+            self.totals['retries']          += status.get('retries',0)
+        self.record('product',identifier=status['identifier'],state=status['state'],
+                    bytes=status['bytes'],bytes_transferred=status.get('bytes_transferred',0),
+                    bytes_skipped=status.get('bytes_skipped',0),retries=status.get('retries',0),
+                    ttfb_s=status.get('ttfb'),seconds=round(seconds,3),
+                    mb_per_s=round(status.get('bytes_transferred',0)/(1024.*1024.)/seconds,3) if seconds > 0 else None)
+
+    def summary(self,hub):
+        elapsed = max(time.time() - self.started,1.e-6)
+        with self.lock:
+            summary = dict(self.totals)
+            summary.update([('products_'+kk,vv) for kk,vv in self.products.items()])
+        summary['hub']             = hub
+        summary['run_seconds']     = round(elapsed,3)
+        summary['mb_per_s']        = round(summary['bytes_transferred']/(1024.*1024.)/elapsed,3)
+        summary['products_per_s']  = round(summary['products_downloaded']/elapsed,4)
+
+        return summary
+
+    def write_json(self,fname,hub):
+        # append this run's records, one JSON document per line
+        with self.lock:
+            records = list(self.records)
+        records.append(dict(self.summary(hub),record='run',
+                            time=datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ')))
+        with open(fname,'a') as f:
+            for rec in records:
+                f.write(json.dumps(rec,sort_keys=True)+'\n')
+
+    def write_prometheus(self,fname,hub):
+        # textfile-collector format; written to a temporary file and renamed,
+        # so that node_exporter never reads half a file. Counters carry on
+        # from the values in the file of the previous run, so that they only
+        # ever go up (Prometheus reads a drop as a counter reset)
+        previous = {}
+        try:
+            with open(fname) as f:
+                for line in f:
+                    if line.strip() != '' and not line.startswith('#'):
+                        series,value = line.rsplit(None,1)
+                        previous[series] = float(value)
+        except (IOError, OSError, ValueError):
+            previous = {}
+
+        summary = self.summary(hub)
+        label   = '{hub="%s"}'%str(hub).replace('\\','\\\\').replace('"','\\"')
+        prefix  = 'sentinel_downloader_'
+        metrics = [('query_duration_seconds_sum','counter',summary['query_seconds']),
+                   ('query_duration_seconds_count','counter',summary['queries']),
+                   ('query_parse_seconds_sum','counter',summary['parse_seconds']),
+                   ('query_entries_total','counter',summary['entries']),
+                   ('time_to_first_byte_seconds_sum','counter',summary['ttfb_seconds']),
+                   ('time_to_first_byte_seconds_count','counter',summary['ttfb_count']),
+                   ('download_duration_seconds_sum','counter',summary['download_seconds']),
+                   ('bytes_transferred_total','counter',summary['bytes_transferred']),
+                   ('bytes_skipped_total','counter',summary['bytes_skipped']),
+                   ('retries_total','counter',summary['retries']),
+                   ('throughput_bytes_per_second','gauge',summary['bytes_transferred']/max(summary['run_seconds'],1.e-3)),
+                   ('run_duration_seconds','gauge',summary['run_seconds']),
+                   ('last_run_timestamp_seconds','gauge',time.time())]
+
+        lines = []
+        for name,kind,value in metrics:
+            series = prefix+name+label
+            if kind == 'counter':
+                value = value + previous.get(series,0.)
+            lines.append('# TYPE %s%s %s'%(prefix,name,kind))
+            lines.append('%s %s'%(series,repr(float(value))))
+        lines.append('# TYPE %sproducts_total counter'%prefix)
+        for state in self.STATES:
+            series = '%sproducts_total%s,state="%s"}'%(prefix,label[:-1],state)
+            lines.append('%s %i'%(series,summary['products_'+state] + int(previous.get(series,0))))
+
+        with open(fname+'.tmp','w') as f:
+            f.write('\n'.join(lines)+'\n')
+        os.rename(fname+'.tmp',fname)
+
+# ------------------------------------------------------------------------------
+class HubPool(object):
+    # equivalent hubs (CODA, the ESA hubs, local mirrors), ranked by latency
+    # and guarded by a circuit breaker each: after Fail_threshold errors in a
+    # row a hub is left alone for Hub_cooldown seconds, after which one
+    # request is let through to see if it has recovered. Only failures of
+    # the hub itself count (see hub_fault), never problems with a product.
+    # When every hub is resting we wait for the first one to reopen rather
+    # than give up. Shared by all download workers, so every update goes
+    # through the lock.
+
+    def __init__(self,urls,fail_threshold=3,cooldown=300.):
+        self.lock      = threading.Lock()
+        self.threshold = fail_threshold
+        self.cooldown  = cooldown
+        self.hubs      = [url.strip().rstrip('/') for url in urls if url.strip()!='']
+        self.latency   = dict([(hub,None) for hub in self.hubs])
+        self.failures  = dict([(hub,0) for hub in self.hubs])
+        self.open_until = dict([(hub,0.) for hub in self.hubs])
+
+    def available(self,hub):
+        return self.open_until[hub] <= time.time()
+
+    def ranked(self,first=None,exclude=()):
+        # usable hubs, fastest first (unprobed ones last, in the order given);
+        # first, if usable, goes to the front
+        wait = self.next_reopen(exclude)
+        if wait > 0:
+            time.sleep(wait)
+        with self.lock:
+            hubs = [hub for hub in self.hubs if self.available(hub) and hub not in exclude]
+            hubs.sort(key=lambda hub: (self.latency[hub] is None,self.latency[hub] or 0.,self.hubs.index(hub)))
+        if first in hubs:
+            hubs.remove(first)
+            hubs.insert(0,first)
+        return hubs
+
+    def best(self,exclude=()):
+        hubs = self.ranked(exclude=exclude)
+        return hubs[0] if len(hubs) > 0 else None
+
+    def next_reopen(self,exclude=()):
+        # seconds until one of the hubs (not excluded) can be used again: 0
+        # if one can be used now, or if there are none
+        with self.lock:
+            times = [self.open_until[hub] for hub in self.hubs if hub not in exclude]
+        if len(times) == 0:
+            return 0.
+        return max(min(times) - time.time(),0.)
+
+    def success(self,hub,latency=None):
+        with self.lock:
+            self.failures[hub]   = 0
+            self.open_until[hub] = 0.
+            if latency is not None:
+                # exponentially weighted, so one slow response does not demote a hub
+                old = self.latency[hub]
+                self.latency[hub] = latency if old is None else 0.7*old + 0.3*latency
+
+    def failure(self,hub,logging):
+        with self.lock:
+            self.failures[hub] += 1
+            if self.failures[hub] >= self.threshold:
+                self.open_until[hub] = time.time() + self.cooldown
+                logging.warning('Hub %s failed %i times in a row: not used for %i s'\
+                                %(hub,self.failures[hub],self.cooldown))
+
+    def probe(self,req_ses,par,logging):
+        # time a minimal search on every hub; hubs that do not answer are
+        # tripped straight away
+        for hub in self.hubs:
+            t0 = time.time()
+            try:
+                r = req_ses.get(hub+'/search?q=*&rows=1', auth=(par['user'],par['pass']),
+                                timeout=par['Probe_timeout'])
+                if r.status_code != 200:
+                    raise Exception('status code %i'%r.status_code)
+                self.success(hub,time.time()-t0)
+                logging.info('Hub %s: %.3f s'%(hub,time.time()-t0))
+            except Exception as err:
+                logging.warning('Hub %s is not answering: %s'%(hub,str(err)))
+                for ii in range(self.threshold):
+                    self.failure(hub,logging)
+
+# ------------------------------------------------------------------------------
+class HubError(IOError):
+    # the hub failed a request (429 or 5xx), as opposed to a problem with the
+    # product that was asked for
+    pass
+
+# ------------------------------------------------------------------------------
+def check_hub_status(r,url_str):
+    # raise HubError if the hub answered with an overload or server error
+    if r.status_code == 429 or r.status_code >= 500:
+        raise HubError('Hub error for %s (code %i)'%(url_str,r.status_code))
+
+# ------------------------------------------------------------------------------
+def hub_fault(err):
+    # does an error count against the hub's circuit breaker: transport
+    # errors, timeouts and 429/5xx answers do, anything else is the product's
+    return isinstance(err,(requests.exceptions.RequestException, urllib3.exceptions.HTTPError, HubError))
+
+# ------------------------------------------------------------------------------
+def hub_pool(par):
+    # the HubPool of the hubs listed in par['url'] (created on first use)
+    if par.get('_hub_pool') is None:
+        par['_hub_pool'] = HubPool(par['url'].split(','),par['Fail_threshold'],par['Hub_cooldown'])
+
+    return par['_hub_pool']
+
+# ------------------------------------------------------------------------------
+def rebuild_catalog(par,logging):
+    # scan root_dir (root_dir/yyyy/mm/dd/* or flat) and record every Sentinel
+    # product found there as archived
+    catalog = par['catalog']
+    product = re.compile(r'^(S[1-3][A-D]_[^.]+)(\.zip|\.SEN3(\.zip)?|\.SAFE(\.zip)?)?$')
+
+    logging.info('Rebuilding product catalog from: '+par['root_dir'])
+    n_found = 0
+    for dirpath, dirnames, filenames in os.walk(par['root_dir']):
+        for name in sorted(dirnames + filenames):
+            match = product.match(name)
+            if match is None:
+                continue
+            path = os.path.join(dirpath,name)
+            if os.path.isdir(path):
+                # unpacked product: don't descend into it
+                dirnames.remove(name)
+                size = None
+            else:
+                size = os.path.getsize(path)
+            catalog.record(match.group(1),'archived',path=os.path.abspath(path),size=size)
+            n_found = n_found + 1
+
+    logging.info('%i products recorded in %s'%(n_found,catalog.db_fname))
+
+    return n_found
+
+# ------------------------------------------------------------------------------
+def open_catalog(par,logging,rebuild=False):
+    # open the product catalog (if enabled) and keep it in par['catalog']
+    if par['catalog_file'] == '':
+        par['catalog'] = None
+        return par
+
+    if not os.path.exists(os.path.dirname(os.path.abspath(par['catalog_file']))):
+        os.makedirs(os.path.dirname(os.path.abspath(par['catalog_file'])))
+
+    logging.info('Using product catalog: '+par['catalog_file'])
+    par['catalog'] = ProductCatalog(par['catalog_file'])
+    if rebuild:
+        rebuild_catalog(par,logging)
+
+    return par
+
+# ------------------------------------------------------------------------------
+def query_key(par):
+    # identify a query by hub and search terms, leaving out the date ranges
+    # that change from run to run
+    terms = ['%s:%s'%(key,par['req'][key]) for key in sorted(par['req'].keys())
+             if key not in ('beginPosition','ingestiondate')]
+
+    return par['url'].rstrip('/') + '|' + ' AND '.join(terms)
+
+# ------------------------------------------------------------------------------
+def apply_watermark(par,logging):
+    # incremental mode: only ask for products ingested since the last run
+    # (less a small overlap for products the hub indexes late)
+    if par['catalog'] is None:
+        raise Exception("incremental mode needs the product catalog, drop --no_catalog")
+
+    par['watermark_key'] = query_key(par)
+    watermark = par['catalog'].get_watermark(par['watermark_key'])
+    if watermark is None:
+        logging.info('No watermark for this query yet: full harvest')
+        return par
+
+    since = datetime.strptime(watermark[:19],'%Y-%m-%dT%H:%M:%S') - timedelta(hours=par['Overlap_hours'])
+    par['req']['ingestiondate'] = '['+since.strftime('%Y-%m-%dT%H:%M:%S')+'.000Z TO NOW]'
+    logging.info('Incremental harvest: products ingested since '+since.strftime('%Y-%m-%dT%H:%M:%S')+\
+                 ' (watermark '+watermark+')')
+
+    return par
+
+# ------------------------------------------------------------------------------
+def update_watermark(par,results,logging):
+    # advance the watermark to the newest ingestion date seen; if anything
+    # failed, hold it at the oldest failure so that the next run asks again.
+    # Pages that were never fetched may hold older products than the newest
+    # seen, so an incomplete query leaves the watermark where it was
+    if par['catalog'] is None or 'watermark_key' not in par or par.get('_newest_ingestion') is None:
+        return
+    if not par.get('_query_complete',False):
+        logging.warning('Query incomplete: watermark not moved')
+        return
+
+    failed = [res['ingestiondate'] for res in results
+              if res['state']=='failed' and res.get('ingestiondate') is not None]
+    if len(failed) > 0:
+        watermark = min(failed)
+        logging.info('%i failed products: holding watermark at %s'%(len(failed),watermark))
+    else:
+        watermark = par['_newest_ingestion']
+
+    old = par['catalog'].get_watermark(par['watermark_key'])
+    if old is None or watermark > old:
+        par['catalog'].set_watermark(par['watermark_key'],watermark)
+        logging.info('Watermark now '+watermark)
+
+    return
+
+# ------------------------------------------------------------------------------
+def Define_request(par,url_hub,start=0):
+    # Define search request (one page of max_rows, from offset start) and set par['hub']
     url_str = url_hub + '/search?q='
    
     for key in par['req'].keys():
         if url_str[-3:]!='?q=': url_str += ' AND '
         url_str += '%s:%s'%(key,par['req'][key])
   
-    url_str += '&rows=%i&start=0'%par['max_rows']
+    url_str += '&rows=%i&start=%i'%(par['max_rows'],start)
     par['hub']=url_hub
 
     return url_str,par
 
 # ------------------------------------------------------------------------------
-def parse_xml(xml_text):
-    # this line is python version dependant!!
-    if sys.version_info[0] == 3:
-        xml_str = re.sub(b' xmlns="[^"]+"', b'', xml_text, count=1)
-    else:
-        xml_str = re.sub(' xmlns="[^"]+"', '', xml_text, count=1)
+# namespace-aware tags of the OpenSearch (Atom) feed returned by the hubs
+ATOM_ENTRY    = '{http://www.w3.org/2005/Atom}entry'
+ATOM_FIELDS   = ('{http://www.w3.org/2005/Atom}str','{http://www.w3.org/2005/Atom}date')
+TOTAL_RESULTS = '{http://a9.com/-/spec/opensearch/1.1/}totalResults'
 
-    root = etree.fromstring(xml_str)
-    entry_list = root.xpath("//entry")
-  
-    res = []
-    for ee in entry_list:
-        dt = {
-              'uuid': ee.xpath("str[@name='uuid']/text()")[0],
-              'identifier': ee.xpath("str[@name='identifier']/text()")[0],
-              'beginposition': ee.xpath("date[@name='beginposition']/text()")[0],
-              'endposition': ee.xpath("date[@name='endposition']/text()")[0],
-             }
-        res.append(dt)
-   
-    return res
+# <str/date name="..."> fields of an entry that we keep
+ENTRY_FIELDS  = ('uuid','identifier','beginposition','endposition',
+                 'ingestiondate','size','footprint')
+
+# unit multipliers for the hub's human readable 'size' field
+SIZE_UNITS    = {'B': 1, 'KB': 1024, 'MB': 1024**2, 'GB': 1024**3, 'TB': 1024**4}
 
 # ------------------------------------------------------------------------------
-def process_request(par,logging):        
+def parse_size(size_str):
+    # '312.54 MB' -> bytes (None if missing or not understood)
+    try:
+        value, unit = size_str.split()
+        return int(float(value)*SIZE_UNITS[unit.upper()])
+    except:
+        return None
 
-    # open requests session
-    with requests.Session() as req_ses:
+# ------------------------------------------------------------------------------
+def parse_footprint(wkt):
+    # WKT POLYGON/MULTIPOLYGON (lon lat) -> list of polygons, each a list of
+    # rings (N x 2 arrays, open), the first ring the outer boundary
+    polygons = []
+    for poly in re.findall(r'\(\s*(\([^()]*\)(?:\s*,\s*\([^()]*\))*)\s*\)',wkt):
+        rings = []
+        for ring in re.findall(r'\(([^()]*)\)',poly):
+            xy = np.array([pp.split() for pp in ring.split(',')],dtype=float)[:,:2]
+            if len(xy) > 1 and np.all(xy[0]==xy[-1]):
+                xy = xy[:-1]
+            rings.append(xy)
+        polygons.append(rings)
+
+    return polygons
+
+# ------------------------------------------------------------------------------
+def clip_ring(ring,box):
+    # Sutherland-Hodgman: clip a ring to the box (lon1,lat1,lon2,lat2), one
+    # box edge at a time, all vertices of the ring at once
+    xmin,ymin,xmax,ymax = box
+    for axis,bound,sign in ((0,xmin,1.),(0,xmax,-1.),(1,ymin,1.),(1,ymax,-1.)):
+        if len(ring) == 0:
+            break
+        nxt = np.roll(ring,-1,axis=0)
+        d0  = sign*(ring[:,axis] - bound)
+        d1  = sign*(nxt[:,axis] - bound)
+        in0 = d0 >= 0
+        cross = in0 != (d1 >= 0)
+        # every edge contributes its start vertex if inside, then its
+        # crossing point with the box edge if it has one
+        t     = np.where(cross, d0/np.where(cross, d0-d1, 1.), 0.)
+        inter = ring + t[:,None]*(nxt-ring)
+        ring  = np.stack([ring,inter],axis=1).reshape(-1,2)[np.stack([in0,cross],axis=1).reshape(-1)]
+
+    return ring
+
+# ------------------------------------------------------------------------------
+def ring_area(ring):
+    # shoelace area of a ring (degrees squared)
+    if len(ring) < 3:
+        return 0.
+    x,y = ring[:,0],ring[:,1]
+    return 0.5*abs(np.dot(x,np.roll(y,-1)) - np.dot(np.roll(x,-1),y))
 
-        # define transport adaptor
-        adaptor = requests.adapters.HTTPAdapter(max_retries=par['Retries'])
-         
-        # define URL
-        url_str,par = Define_request(par,par['url'])
+# ------------------------------------------------------------------------------
+def footprint_coverage(wkt,box):
+    # fraction of the box (lon1,lat1,lon2,lat2) covered by a footprint (None
+    # if there is no usable footprint)
+    try:
+        polygons = parse_footprint(wkt)
+    except (TypeError, ValueError):
+        return None
+    if len(polygons) == 0:
+        return None
+
+    area = 0.
+    for rings in polygons:
+        if np.ptp(rings[0][:,0]) > 180.:
+            # across the antimeridian: unwrap to 0..360, and clip to the box
+            # on both sides of it
+            rings = [np.column_stack([np.where(rr[:,0] < 0.,rr[:,0]+360.,rr[:,0]),rr[:,1]]) for rr in rings]
+        for shift in (0.,360.):
+            shifted = (box[0]+shift,box[1],box[2]+shift,box[3])
+            area += ring_area(clip_ring(rings[0],shifted))
+            for hole in rings[1:]:
+                area -= ring_area(clip_ring(hole,shifted))
+
+    return min(max(area/((box[2]-box[0])*(box[3]-box[1])),0.),1.)
 
+# ------------------------------------------------------------------------------
+def iterparse_feed(xml_source,feed=None,aoi=None):
+    # generator: stream through a search feed (bytes or file object) and
+    # yield one compact dict per <entry>. Each entry is freed once read, so
+    # memory does not grow with the size of the feed. The total number of
+    # results is stored in feed['total'] as soon as it is seen, and the
+    # number of <entry> elements read (those without a uuid or identifier,
+    # which are not yielded, included) in feed['entries']. If an area of
+    # interest box is given, the fraction of it each footprint covers is
+    # added as 'coverage'.
+    if isinstance(xml_source,bytes):
+        xml_source = io.BytesIO(xml_source)
+
+    for event, elem in etree.iterparse(xml_source, events=('end',), tag=(ATOM_ENTRY,TOTAL_RESULTS)):
+        if elem.tag == TOTAL_RESULTS:
+            if feed is not None:
+                feed['total'] = int(elem.text)
+            continue
+        if feed is not None:
+            feed['entries'] = feed.get('entries',0) + 1
+
+        dt = dict.fromkeys(ENTRY_FIELDS)
+        for child in elem.iterchildren(*ATOM_FIELDS):
+            name = child.get('name')
+            if name in dt:
+                dt[name] = child.text
+        dt['size'] = parse_size(dt['size'])
+        if aoi is not None:
+            dt['coverage'] = footprint_coverage(dt['footprint'],aoi)
+
+        # free this entry and everything before it
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+        if dt['uuid'] is None or dt['identifier'] is None:
+            continue
+        yield dt
+
+# ------------------------------------------------------------------------------
+def parse_xml(xml_text,aoi=None):
+    # parse one page of search results: returns (entries, total results)
+    feed = {'total': None}
+    res  = list(iterparse_feed(xml_text,feed,aoi))
+
+    return res,feed['total']
+
+# ------------------------------------------------------------------------------
+def process_request(par,logging,req_ses=None):
+    # generator: query the hub one page at a time, following the start= offset
+    # until the feed runs out, and yield the entries as each page is parsed so
+    # that downloading can begin before the last page has been fetched.
+    # par['_query_complete'] is only set once every result has been fetched:
+    # a page that no hub will serve ends the results early, and the caller
+    # must not mistake that for the end of the feed
+
+    # open requests session (unless we are handed one)
+    own_session = req_ses is None
+    if own_session:
+        req_ses = open_session(par)
+
+    try:
         # ------------------------------------------------------------------------
         # Request available files
         logging.info("Processing request at specified data HUB ... ")
 
-        # try to connect to primary hub first:
-        req_ses.mount(par['hub'], adaptor)
-        logging.info('Querying data at: ' + par['hub'])
-        logging.info('Query: ' + url_str)
-        r = req_ses.get(url_str, auth=(par['user'],par['pass']), timeout=par['Timeout'])
-        logging.info('Code '+par['url']+': ' + str(r.status_code))
-
-        if r.status_code != 200:
-            req_ses.close()
-            logging.error("Data query to "+par['hub']+" was not successful! ("+str(par['Retries'])+" retries)")
+        start      = 0
+        n_archived = 0
+        n_marginal = 0
+        par['_newest_ingestion'] = None
+        par['_query_complete']   = False
+        par['total_results']     = None
+        hubs = hub_pool(par)
+        while True:
+            # every page goes to the best hub available, failing over to the
+            # next one when a hub errors or times out
+            tried = []
+            while True:
+                hub = hubs.best(exclude=tried)
+                if hub is None:
+                    logging.error("Data query was not successful on any hub! (tried: "+', '.join(tried)+")")
+                    logging.error("Query incomplete: %i of %s results fetched"\
+                                  %(start,'?' if par['total_results'] is None else str(par['total_results'])))
+                    return
+                tried.append(hub)
+
+                # define URL
+                url_str,par = Define_request(par,hub,start=start)
+
+                logging.info('Querying data at: ' + par['hub'])
+                logging.info('Query: ' + url_str)
+                t0 = time.time()
+                try:
+                    r = req_ses.get(url_str, auth=(par['user'],par['pass']), timeout=par['Timeout'])
+                    feed_xml = r.content
+                except requests.exceptions.RequestException as err:
+                    logging.warning('Query to '+hub+' failed: '+str(err))
+                    hubs.failure(hub,logging)
+                    continue
+                latency = time.time() - t0
+                logging.info('Code '+hub+': ' + str(r.status_code))
+
+                if r.status_code == 200:
+                    hubs.success(hub,latency)
+                    break
+                par['metrics'].query(url_str,r.status_code,latency,0.,0)
+                logging.warning("Data query to "+hub+" was not successful (code "+str(r.status_code)+")")
+                if r.status_code == 429 or r.status_code >= 500:
+                    hubs.failure(hub,logging)
 
-        logging.info("Done")
-        if r.status_code == 200:
             # parse xml code: extract image names and UUID
-            entries = parse_xml(r.content)
-            if len(entries)>=par['max_rows']:
-                logging.error("The number of scenes ("+str(len(entries))+") is greater than maximum ("+str(par['max_rows'])+"): increase max_rows!")
-                req_ses.close()
-                raise Exception("The number of scenes ("+str(len(entries))+") is greater than maximum ("+str(par['max_rows'])+"): increase max_rows!")
-        else:
-            entries = False
+            t0 = time.time()
+            feed    = {'total': None, 'entries': 0}
+            entries = list(iterparse_feed(feed_xml,feed,par['aoi']))
+            total   = feed['total']
+            par['metrics'].query(url_str,r.status_code,latency,time.time()-t0,len(entries))
+            if start == 0:
+                par['total_results'] = total
+                logging.info("The query matches %s products"%str(total))
+
+            for ee in entries:
+                # uuids are hub specific: remember where this one came from
+                ee['hub'] = hub
+
+                # newest ingestion date seen, for the incremental watermark
+                if ee['ingestiondate'] is not None and \
+                   (par['_newest_ingestion'] is None or ee['ingestiondate'] > par['_newest_ingestion']):
+                    par['_newest_ingestion'] = ee['ingestiondate']
+
+                # drop scenes that only clip the area of interest
+                if par['Min_coverage'] > 0 and ee.get('coverage') is not None and \
+                   ee['coverage'] < par['Min_coverage']:
+                    logging.info('%s covers %.1f%% of the area: not requested'%(ee['identifier'],100.*ee['coverage']))
+                    n_marginal = n_marginal + 1
+                    continue
+
+                # don't even hand over products we already hold
+                if par['Skip_archived'] and par['catalog'] is not None and \
+                   par['catalog'].is_archived(ee['identifier']):
+                    n_archived = n_archived + 1
+                    par['metrics'].add(bytes_skipped=ee['size'] or 0)
+                    continue
+                yield ee
+
+            # the next page starts after every entry of this one, malformed
+            # ones included; stop once we have seen everything (or, if the
+            # hub gives no total, on a short page), or on an empty page
+            if feed['entries'] > len(entries):
+                logging.warning('%i malformed entries (no uuid or identifier) skipped'%(feed['entries']-len(entries)))
+            start += feed['entries']
+            if feed['entries'] == 0 or (total is not None and start >= total) or \
+               (total is None and feed['entries'] < par['max_rows']):
+                break
+
+        if total is not None and start < total:
+            logging.error("Query incomplete: the hub stopped returning results at %i of %i"%(start,total))
+            return
+        par['_query_complete'] = True
+
+        if n_archived > 0:
+            logging.info("%i products already archived (catalog): not requested"%n_archived)
+        if n_marginal > 0:
+            logging.info("%i products below %.1f%% coverage of the area: not requested"\
+                         %(n_marginal,100.*par['Min_coverage']))
+        logging.info("Done")
+    finally:
+        if own_session:
+            req_ses.close()
 
-    return entries
+# ------------------------------------------------------------------------------
+def open_session(par):
+    # open a requests session whose connection pool is large enough to be
+    # shared by all download workers
+    # failed connections and overloaded-hub responses are retried with
+    # exponential backoff (Backoff_factor * 2**retry seconds), honouring
+    # any Retry-After the hub sends
+    retries = urllib3.util.retry.Retry(total=par['Retries'], backoff_factor=par['Backoff_factor'],
+                                       status_forcelist=(429,500,502,503,504),
+                                       respect_retry_after_header=True)
+    # downloads (and their segments and members) take hub slots, so at most
+    # Hub_connections of them reach any one hub, plus the query
+    req_ses = requests.Session()
+    adaptor = requests.adapters.HTTPAdapter(max_retries=retries,
+                                            pool_connections=4,
+                                            pool_maxsize=max(par['Concurrency'],par['Hub_connections'],1)+1)
+    req_ses.mount('https://', adaptor)
+    req_ses.mount('http://', adaptor)
+
+    return req_ses
 
 # ------------------------------------------------------------------------------
-def download_files(par,entries,logging):
-    # open requests session
-    with requests.Session() as req_ses:
+def hub_slot(par,url_str):
+    # return the semaphore limiting simultaneous connections to the hub
+    # serving url_str (one per scheme+host, created on first use)
+    hub_key = '/'.join(url_str.split('/')[:3])
+    with par['_slots_lock']:
+        if hub_key not in par['_hub_slots']:
+            par['_hub_slots'][hub_key] = threading.BoundedSemaphore(max(par['Hub_connections'],1))
 
-        # ----------------------------------------------------------------------
-        # Create temp_dir
-        temp_dir = tempfile.mkdtemp(suffix='_esa_downloader')
-        # ----------------------------------------------------------------------
-        # download files
-        logging.info("Started downloading %i files ..."%len(entries))
-        for ee in entries:
-            split_id = ee['identifier'].split('_')
-            sensor   = split_id[0][:2]
+    return par['_hub_slots'][hub_key]
+
+# ------------------------------------------------------------------------------
+def archive_dir(par,ee,logging):
+    # work out the sensing time of a product from its identifier and return
+    # the archive directory it belongs in (None if not a Sentinel name)
+    split_id = ee['identifier'].split('_')
+    sensor   = split_id[0][:2]
 
-            # check if the file already exists in the archive
+    try:
+        if sensor.lower()=='s1':
+            dtime = datetime.strptime(split_id[5], '%Y%m%dT%H%M%S')
+        elif sensor.lower()=='s2':
+            # annoying date format change
             try:
-                if sensor.lower()=='s1':
-                    dtime = datetime.strptime(split_id[5], '%Y%m%dT%H%M%S')
-                elif sensor.lower()=='s2':
-                    # annoying date format change
-                    try:
-                        logging.info('Trying for old date format')
-                        dtime = datetime.strptime(split_id[5], '%Y%m%dT%H%M%S')
-                    except:
-                        logging.info('Failed: Trying for new date format')
-                        dtime = datetime.strptime(split_id[6], '%Y%m%dT%H%M%S')
-                elif sensor.lower()=='s3':
-                    dtime = datetime.strptime(ee['identifier'][16:31], '%Y%m%dT%H%M%S')
-                else:
-                    logging.error("Not a Sentinel file name!")
-                    raise Exception("Not a Sentinel file name!")
+                logging.info('Trying for old date format')
+                dtime = datetime.strptime(split_id[5], '%Y%m%dT%H%M%S')
             except:
-                logging.warning('Unknown file format...skipping this url: '+ee['identifier'])
-                continue
+                logging.info('Failed: Trying for new date format')
+                dtime = datetime.strptime(split_id[6], '%Y%m%dT%H%M%S')
+        elif sensor.lower()=='s3':
+            dtime = datetime.strptime(ee['identifier'][16:31], '%Y%m%dT%H%M%S')
+        else:
+            logging.error("Not a Sentinel file name!")
+            raise Exception("Not a Sentinel file name!")
+    except:
+        logging.warning('Unknown file format...skipping this url: '+ee['identifier'])
+        return None
 
-            if par['make_sub_dir']:
-                arc_dir = os.path.join(par['root_dir'],dtime.strftime('%Y/%m/%d'))
-            else:
-                arc_dir = par['root_dir']
-      
-            fname = os.path.join(arc_dir,ee['identifier']+'*')
-            fnames = glob(fname)
+    if par['make_sub_dir']:
+        arc_dir = os.path.join(par['root_dir'],dtime.strftime('%Y/%m/%d'))
+    else:
+        arc_dir = par['root_dir']
 
-            # build url string & isolate file
-            url_str = par['hub'] + "/odata/v1/Products('%s')/$value"%ee['uuid']
-            try:
-                r     = req_ses.get(url_str, auth=(par['user'], par['pass']), stream=True)
-            except:
-                logging.warning('Hub misbehaving, skipping this url')
-                logging.info('>>> '+url_str)
+    return arc_dir
+
+# ------------------------------------------------------------------------------
+def response_size(r,offset=0):
+    # total size of the product behind a (possibly partial) response
+    try:
+        return int(r.headers['content-range'].split('/')[1])
+    except:
+        return offset + int(r.headers['content-length'])
+
+# ------------------------------------------------------------------------------
+class TokenBucket(object):
+    # global download rate limit (bytes/s, None for unlimited) shared by all
+    # download streams. Streams take tokens for every buffer they read and
+    # sleep off any debt, so the total rate holds however many streams there
+    # are. The rate can be changed while running with set_rate, or by
+    # writing a new value (Mb/s, 0 for unlimited) into the rate file, which
+    # is looked at every few seconds.
+
+    def __init__(self,rate,rate_file='',logging=None):
+        self.lock      = threading.Lock()
+        self.rate      = rate
+        self.tokens    = 0.
+        self.last      = time.time()
+        self.rate_file = rate_file
+        self.logging   = logging
+        self.checked   = 0.
+        self.mtime     = None
+
+    def set_rate(self,rate):
+        with self.lock:
+            self.rate = rate if rate else None
+            if self.logging is not None:
+                self.logging.info('Download rate limit: '+('%.2f Mb/s'%(rate/(1024.*1024.)) if rate else 'none'))
+
+    def check_rate_file(self):
+        # re-read the rate file if it has changed (every 5 s at most)
+        if self.rate_file=='' or time.time() - self.checked < 5.:
+            return
+        self.checked = time.time()
+        try:
+            mtime = os.path.getmtime(self.rate_file)
+            if mtime == self.mtime:
+                return
+            self.mtime = mtime
+            with open(self.rate_file) as f:
+                rate = float(f.read().strip())*1024*1024
+        except (IOError, OSError, ValueError):
+            return
+        self.set_rate(rate)
+
+    def consume(self,nbytes):
+        self.check_rate_file()
+        with self.lock:
+            now       = time.time()
+            self.last, elapsed = now, now - self.last
+            if self.rate is None:
+                return
+            # at most one second's worth of burst
+            self.tokens = min(self.tokens + elapsed*self.rate, self.rate) - nbytes
+            wait        = -self.tokens/self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+# ------------------------------------------------------------------------------
+def copy_stream(r,f,buf_size,hasher=None,bucket=None):
+    # generator: copy the body of r into the open file f through one
+    # preallocated buffer, yielding the number of bytes of every write. If a
+    # hasher is given it is updated from the same buffer as the bytes go by;
+    # if a token bucket is given, reading is held to its rate.
+    buf  = bytearray(buf_size)
+    view = memoryview(buf)
+    r.raw.decode_content = True
+    while True:
+        nbytes = r.raw.readinto(view)
+        if not nbytes:
+            break
+        if bucket is not None:
+            bucket.consume(nbytes)
+        f.write(view[:nbytes])
+        if hasher is not None:
+            hasher.update(view[:nbytes])
+        yield nbytes
+
+# ------------------------------------------------------------------------------
+def hash_file(fname,hasher,buf_size,nbytes=None):
+    # feed (the first nbytes of) a file on disk into hasher
+    with open(fname,'rb') as f:
+        remaining = os.path.getsize(fname) if nbytes is None else nbytes
+        while remaining > 0:
+            chunk = f.read(min(buf_size,remaining))
+            if not chunk:
+                break
+            hasher.update(chunk)
+            remaining = remaining - len(chunk)
+
+    return hasher
+
+# ------------------------------------------------------------------------------
+def product_checksum(req_ses,par,ee,logging):
+    # MD5 published by the hub in the OData product metadata (None if the
+    # hub does not give one)
+    url_str = ee['hub'] + "/odata/v1/Products('%s')?$format=json"%ee['uuid']
+    try:
+        r = req_ses.get(url_str, auth=(par['user'], par['pass']), timeout=par['Timeout'])
+        checksum = r.json()['d']['Checksum']
+        if checksum['Algorithm'].upper() != 'MD5':
+            raise Exception('unsupported checksum algorithm '+checksum['Algorithm'])
+        return checksum['Value'].lower()
+    except Exception as err:
+        logging.warning('No checksum available for '+ee['identifier']+': '+str(err))
+        return None
+
+# ------------------------------------------------------------------------------
+def stream_to_file(r,part_fname,offset,file_size,base_fname,par,hasher,stats,logging):
+    # write the body of r to part_fname, appending from byte offset, hashing
+    # as we go. Progress is logged every 10%: a single integer comparison per
+    # buffer. The bytes written are added to stats['bytes_transferred'].
+    done        = offset
+    step        = max(file_size//10,1)
+    next_report = (done//step + 1)*step
+    try:
+        with open(part_fname, 'ab' if offset > 0 else 'wb') as f:
+            for nbytes in copy_stream(r,f,par['Buffer_size'],hasher,par['_bucket']):
+                done = done + nbytes
+                if done >= next_report:
+                    logging.info('%s: %i%% complete, %.1f Mb downloaded'\
+                                 %(base_fname,done*100//file_size,done/(1024.*1024.)))
+                    next_report = (done//step + 1)*step
+    finally:
+        # counted even if the transfer is interrupted
+        stats['bytes_transferred'] += done - offset
+
+    return
+
+# ------------------------------------------------------------------------------
+def download_segmented(req_ses,par,url_str,part_fname,file_size,stats,logging):
+    # fetch the product as par['Segments'] byte ranges in parallel, each one
+    # written in place into a preallocated part file. The progress of every
+    # range is kept in a sidecar file so an interrupted run picks up where it
+    # stopped. Every range in flight is a connection to the hub, so ranges
+    # only run in parallel on hub slots that are free (besides the one the
+    # product holds). Returns False if the hub does not honour range
+    # requests; a range that fails raises, to be resumed like any download.
+    seg_fname = part_fname+'.segments'
+    lock      = threading.Lock()
+
+    segments = None
+    if os.path.exists(seg_fname) and os.path.exists(part_fname):
+        try:
+            with open(seg_fname) as f:
+                state = json.load(f)
+            if state['size'] == file_size:
+                segments = state['segments']
+        except:
+            logging.warning('Unreadable segment state, restarting: '+seg_fname)
+
+    if segments is None:
+        step     = int(np.ceil(file_size/float(par['Segments'])))
+        segments = [[ii, min(ii+step,file_size)-1, ii] for ii in range(0,file_size,step)]
+        with open(part_fname,'wb') as f:
+            f.truncate(file_size)
+
+    def save_state():
+        with lock:
+            with open(seg_fname+'.tmp','w') as f:
+                json.dump({'size': file_size, 'segments': segments}, f)
+            os.rename(seg_fname+'.tmp',seg_fname)
+
+    def fetch_segment(seg):
+        # seg = [first byte, last byte, first byte not yet safely on disk]
+        if seg[2] > seg[1]:
+            return True
+        r = req_ses.get(url_str, auth=(par['user'], par['pass']), stream=True, timeout=par['Timeout'],
+                        headers={'Range': 'bytes=%i-%i'%(seg[2],seg[1])})
+        par['metrics'].first_byte(r.elapsed.total_seconds())
+        start = pos = seg[2]
+        try:
+            if r.status_code == 200:
+                # the whole product: the hub ignores ranges
+                return False
+            if r.status_code != 206:
+                check_hub_status(r,url_str)
+                raise IOError('Segment %i-%i of %s failed (code %i)'%(seg[2],seg[1],url_str,r.status_code))
+            with open(part_fname,'r+b') as f:
+                f.seek(pos)
+                for nbytes in copy_stream(r,f,par['Buffer_size'],bucket=par['_bucket']):
+                    pos += nbytes
+                    # only record bytes that have been flushed
+                    if pos - seg[2] >= 16*1024*1024:
+                        f.flush()
+                        seg[2] = pos
+                        save_state()
+                f.flush()
+                seg[2] = pos
+        finally:
+            r.close()
+            save_state()
+            with lock:
+                stats['bytes_transferred'] += pos - start
+        return True
+
+    done = sum([seg[2]-seg[0] for seg in segments])
+    logging.info('Fetching %s in %i segments (%.1f Mb already on disk)'\
+                 %(os.path.basename(part_fname),len(segments),done/(1024.*1024.)))
+    slot  = hub_slot(par,url_str)
+    extra = 0
+    while extra < len(segments)-1 and slot.acquire(blocking=False):
+        extra = extra + 1
+    try:
+        with ThreadPoolExecutor(max_workers=extra+1) as pool:
+            jobs = [pool.submit(fetch_segment,seg) for seg in segments]
+            ranged,errors = [],[]
+            for job in jobs:
+                try:
+                    ranged.append(job.result())
+                except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError, IOError) as err:
+                    errors.append(err)
+    finally:
+        for ii in range(extra):
+            slot.release()
+
+    if len(errors) > 0 and all(ranged):
+        # finished ranges are kept in the part file for the retry
+        raise errors[0]
+
+    if not all(ranged):
+        logging.info('Hub does not support range requests: not segmenting')
+        os.remove(seg_fname)
+        return False
+
+    if any([seg[2] <= seg[1] for seg in segments]):
+        raise IOError('Incomplete segment(s) in '+part_fname)
+
+    os.remove(seg_fname)
+
+    return True
+
+# ------------------------------------------------------------------------------
+def fetch_product(req_ses,par,url_str,part_fname,stats,logging):
+    # download (or resume downloading) a product into part_fname; returns the
+    # hub's file name for the product and the MD5 of the bytes on disk, or
+    # None if the hub is misbehaving. Time to first byte and bytes
+    # transferred are accumulated in stats.
+    seg_fname = part_fname+'.segments'
+
+    # resume from whatever is already on disk
+    offset  = 0
+    headers = {}
+    if os.path.exists(part_fname) and not os.path.exists(seg_fname):
+        offset = os.path.getsize(part_fname)
+        if offset > 0:
+            headers['Range'] = 'bytes=%i-'%offset
+
+    r = req_ses.get(url_str, auth=(par['user'], par['pass']), stream=True, timeout=par['Timeout'],
+                    headers=headers)
+    # elapsed runs up to the arrival of the response headers
+    par['metrics'].first_byte(r.elapsed.total_seconds())
+    if stats['ttfb'] is None:
+        stats['ttfb'] = round(r.elapsed.total_seconds(),6)
+    try:
+        # an overloaded hub: retried later, keeping what is on disk
+        check_hub_status(r,url_str)
+    except HubError:
+        r.close()
+        raise
+
+    if offset > 0 and r.status_code != 206:
+        # range ignored or refused: start again from scratch
+        logging.info('Cannot resume, restarting: '+url_str)
+        r.close()
+        os.remove(part_fname)
+        return fetch_product(req_ses,par,url_str,part_fname,stats,logging)
+
+    # check file size
+    try:
+        base_fname = r.headers['content-disposition'].split('=')[1].strip('"')
+        file_size  = response_size(r,offset)
+    except:
+        r.close()
+        return None
+
+    # big products: fetch N byte ranges in parallel instead
+    if offset == 0 and par['Segments'] > 1 and file_size >= par['Segment_min_size']:
+        r.close()
+        if download_segmented(req_ses,par,url_str,part_fname,file_size,stats,logging):
+            # ranges arrive out of order: hash the assembled file once
+            hasher = hash_file(part_fname,hashlib.md5(),par['Buffer_size'])
+            return base_fname,hasher.hexdigest()
+        r = req_ses.get(url_str, auth=(par['user'], par['pass']), stream=True, timeout=par['Timeout'])
+    elif os.path.exists(seg_fname):
+        os.remove(seg_fname)
+
+    # the hash covers the bytes already on disk, then the stream
+    hasher = hashlib.md5()
+    if offset > 0:
+        logging.info("Resuming %s at %.1f Mb ... "%(base_fname,offset/(1024.*1024.)))
+        hash_file(part_fname,hasher,par['Buffer_size'],offset)
+    else:
+        logging.info("Downloading %s ... "%base_fname)
+
+    try:
+        stream_to_file(r,part_fname,offset,file_size,base_fname,par,hasher,stats,logging)
+    finally:
+        r.close()
+
+    if os.path.getsize(part_fname) != file_size:
+        raise IOError('Incomplete download of '+base_fname)
+
+    return base_fname,hasher.hexdigest()
+
+# ------------------------------------------------------------------------------
+def fetch_with_resume(req_ses,par,ee,url_str,part_fname,stats,logging):
+    # fetch_product, resuming up to par['Resume_retries'] times when the
+    # transfer is interrupted; False if we had to give up
+    for attempt in range(par['Resume_retries']+1):
+        if attempt > 0:
+            stats['retries'] += 1
+            time.sleep(par['Backoff_factor']*2**(attempt-1))
+        try:
+            return fetch_product(req_ses,par,url_str,part_fname,stats,logging)
+        except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError, IOError) as err:
+            logging.warning('Download of '+ee['identifier']+' interrupted: '+str(err))
+            if hub_fault(err):
+                stats['hub_error'] = True
+
+    return False
+
+# ------------------------------------------------------------------------------
+def new_status(ee):
+    # the status dict of a product, filled in as it is downloaded
+    return {'identifier': ee['identifier'], 'state': 'skipped', 'bytes': 0,
+            'ingestiondate': ee.get('ingestiondate'), 'bytes_transferred': 0,
+            'bytes_skipped': 0, 'retries': 0, 'ttfb': None, 'hub_error': False}
+
+# ------------------------------------------------------------------------------
+def bytes_on_disk(part_fname):
+    # bytes of a partial download already safely on disk
+    seg_fname = part_fname+'.segments'
+    if os.path.exists(seg_fname):
+        try:
+            with open(seg_fname) as f:
+                return sum([seg[2]-seg[0] for seg in json.load(f)['segments']])
+        except:
+            return 0
+    if os.path.exists(part_fname):
+        return os.path.getsize(part_fname)
+
+    return 0
+
+# ------------------------------------------------------------------------------
+def resolve_uuid(req_ses,par,hub,identifier,logging):
+    # uuids are hub specific: look a product up on another hub by identifier
+    url_str = hub + '/search?q=identifier:%s&rows=1'%identifier
+    try:
+        r = req_ses.get(url_str, auth=(par['user'],par['pass']), timeout=par['Timeout'])
+        entries,total = parse_xml(r.content)
+        if r.status_code == 200 and len(entries) > 0:
+            return entries[0]['uuid']
+        logging.info(identifier+' is not on '+hub)
+    except Exception as err:
+        logging.warning('Cannot look up '+identifier+' on '+hub+': '+str(err))
+
+    return None
+
+# ------------------------------------------------------------------------------
+def download_from_hub(req_ses,par,ee,part_fname,status,logging):
+    # download and verify a product from the hub ee['hub']; returns the
+    # outcome ('ok', 'failed', 'corrupt' or 'misbehaving'), what
+    # fetch_product returned and the hub's checksum
+    url_str  = ee['hub'] + "/odata/v1/Products('%s')/$value"%ee['uuid']
+    expected = None
+    with hub_slot(par,url_str):
+        # the hub's MD5, checked against the hash computed while streaming
+        if par['Verify_checksum']:
+            expected = product_checksum(req_ses,par,ee,logging)
+
+        for attempt in range(par['Checksum_retries']+1):
+            if attempt > 0:
+                status['retries'] += 1
+            fetched = fetch_with_resume(req_ses,par,ee,url_str,part_fname,status,logging)
+            if not fetched:
+                break
+            base_fname,checksum = fetched
+            if expected is None or checksum == expected:
+                return 'ok',fetched,expected
+            logging.warning('Checksum mismatch for %s (%s, hub says %s): downloading again'\
+                            %(ee['identifier'],checksum,expected))
+            os.remove(part_fname)
+        else:
+            logging.error('Corrupt download of '+ee['identifier']+' from '+ee['hub'])
+            return 'corrupt',None,expected
+
+    if fetched is None:
+        logging.info('Hub misbehaving, skipping this url')
+        logging.info('>>> '+url_str)
+        return 'misbehaving',None,expected
+
+    logging.warning('Download of '+ee['identifier']+' from '+ee['hub']+' failed')
+
+    return 'failed',None,expected
+
+# manifests of SAFE-style products: always fetched with selected members, so
+# that the result is a valid product directory and the members can be checked
+MANIFESTS = ('xfdumanifest.xml','manifest.safe')
+
+# ------------------------------------------------------------------------------
+def list_nodes(req_ses,par,node_url):
+    # children of a node of the OData Nodes tree, as (name, url, size, is_dir)
+    r = req_ses.get(node_url+'/Nodes?$format=json', auth=(par['user'], par['pass']), timeout=par['Timeout'])
+    check_hub_status(r,node_url)
+    if r.status_code != 200:
+        raise IOError('Cannot list %s (code %i)'%(node_url,r.status_code))
+
+    nodes = []
+    for node in r.json()['d']['results']:
+        nodes.append((node['Name'], node_url+"/Nodes('%s')"%node['Name'],
+                      int(node.get('ContentLength') or 0), int(node.get('ChildrenNumber') or 0) > 0))
+
+    return nodes
+
+# ------------------------------------------------------------------------------
+def walk_nodes(req_ses,par,node_url,rel_path=''):
+    # generator: every file below node_url as (path relative to it, url, size)
+    for name,url,size,is_dir in list_nodes(req_ses,par,node_url):
+        path = name if rel_path=='' else rel_path+'/'+name
+        if is_dir:
+            for item in walk_nodes(req_ses,par,url,path):
+                yield item
+        else:
+            yield path,url,size
+
+# ------------------------------------------------------------------------------
+def member_selected(path,patterns):
+    # match a member against the --members patterns, by path or by file name
+    return any([fnmatch(path,pp) or fnmatch(os.path.basename(path),pp) for pp in patterns])
+
+# ------------------------------------------------------------------------------
+def manifest_checksums(fname):
+    # MD5 of every file listed in a SAFE/SEN3 manifest, by relative path
+    sums = {}
+    for stream in etree.parse(fname).iter('{*}byteStream'):
+        location = stream.find('{*}fileLocation')
+        checksum = stream.find('{*}checksum')
+        if location is None or checksum is None or checksum.get('checksumName','MD5').upper() != 'MD5':
+            continue
+        sums[os.path.normpath(location.get('href'))] = checksum.text.strip().lower()
+
+    return sums
+
+# ------------------------------------------------------------------------------
+def fetch_member(req_ses,par,url_str,fname,size):
+    # fetch one member of a product (resuming a partial file); returns the
+    # MD5 of the file and the number of bytes transferred
+    offset = os.path.getsize(fname) if os.path.exists(fname) else 0
+    hasher = hashlib.md5()
+    if offset > 0:
+        hash_file(fname,hasher,par['Buffer_size'],offset)
+    if offset == size and size > 0:
+        return hasher.hexdigest(),0
+
+    headers = {'Range': 'bytes=%i-'%offset} if offset > 0 else {}
+    with hub_slot(par,url_str):
+        r = req_ses.get(url_str+'/$value', auth=(par['user'], par['pass']), stream=True,
+                        timeout=par['Timeout'], headers=headers)
+        try:
+            if offset > 0 and r.status_code == 200:
+                # range ignored: start again
+                offset = 0
+                hasher = hashlib.md5()
+            elif r.status_code not in ((206,) if offset > 0 else (200,206)):
+                # (an error answer must not overwrite the partial file)
+                check_hub_status(r,url_str)
+                raise IOError('Cannot fetch %s (code %i)'%(url_str,r.status_code))
+            with open(fname,'ab' if offset > 0 else 'wb') as f:
+                for nbytes in copy_stream(r,f,par['Buffer_size'],hasher,par['_bucket']):
+                    pass
+        finally:
+            r.close()
+
+    if size > 0 and os.path.getsize(fname) != size:
+        raise IOError('Incomplete download of '+url_str)
+
+    return hasher.hexdigest(),os.path.getsize(fname)-offset
+
+# ------------------------------------------------------------------------------
+def download_members(req_ses,par,ee,arc_dir,status,logging):
+    # fetch only the members of a product matching par['Members'] (and its
+    # manifest) through the OData Nodes API, concurrently, and assemble them
+    # into the product's .SEN3/.SAFE directory in the archive. Returns 'ok',
+    # 'failed' or 'corrupt', like download_from_hub.
+    prod_url = ee['hub'] + "/odata/v1/Products('%s')"%ee['uuid']
+    try:
+        top_name,top_url,top_size,top_is_dir = list_nodes(req_ses,par,prod_url)[0]
+        members = [(path,url,size) for path,url,size in walk_nodes(req_ses,par,top_url)
+                   if path in MANIFESTS or member_selected(path,par['Members'])]
+    except (requests.exceptions.RequestException, IOError, ValueError, KeyError, IndexError) as err:
+        logging.warning('Cannot read the Nodes tree of '+ee['identifier']+': '+str(err))
+        status['hub_error'] = hub_fault(err)
+        return 'failed'
+
+    missing = [pp for pp in par['Members'] if not any([member_selected(mm[0],[pp]) for mm in members])]
+    if len(missing) > 0:
+        logging.warning('Not in '+top_name+': '+', '.join(missing))
+
+    # staged by uuid next to the archive, so that an interrupted product
+    # is resumed member by member
+    stage_root = os.path.join(arc_dir,'.'+ee['uuid']+'.nodes')
+    stage_dir  = os.path.join(stage_root,top_name)
+    for path,url,size in members:
+        if not os.path.exists(os.path.dirname(os.path.join(stage_dir,path))):
+            os.makedirs(os.path.dirname(os.path.join(stage_dir,path)))
+    status['bytes_skipped'] = sum([os.path.getsize(os.path.join(stage_dir,path)) for path,url,size in members
+                                   if os.path.exists(os.path.join(stage_dir,path))])
+
+    logging.info('Fetching %i members of %s (%.1f Mb) ...'%(len(members),top_name,
+                                                        sum([mm[2] for mm in members])/(1024.*1024.)))
+    try:
+        with ThreadPoolExecutor(max_workers=max(par['Member_concurrency'],1)) as pool:
+            jobs    = [pool.submit(fetch_member,req_ses,par,url,os.path.join(stage_dir,path),size)
+                       for path,url,size in members]
+            fetched = [job.result() for job in jobs]
+        sums = dict([(mm[0],ff[0]) for mm,ff in zip(members,fetched)])
+        status['bytes_transferred'] += sum([ff[1] for ff in fetched])
+    except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError, IOError) as err:
+        logging.warning('Download of members of '+ee['identifier']+' interrupted: '+str(err))
+        status['hub_error'] = hub_fault(err)
+        return 'failed'
+
+    # check the members against the MD5s in the manifest
+    if par['Verify_checksum']:
+        for manifest in [path for path,url,size in members if path in MANIFESTS]:
+            expected = manifest_checksums(os.path.join(stage_dir,manifest))
+            bad = [path for path in sums if path in expected and sums[path] != expected[path]]
+            if len(bad) > 0:
+                logging.error('Checksum mismatch for '+', '.join(bad)+' of '+ee['identifier'])
+                for path in bad:
+                    os.remove(os.path.join(stage_dir,path))
+                return 'corrupt'
+            logging.info('Checksums verified for %i members of %s'\
+                         %(len([path for path in sums if path in expected]),ee['identifier']))
+
+    # move into place
+    arc_fname = os.path.join(arc_dir,top_name)
+    os.replace(stage_dir,arc_fname)
+    os.rmdir(stage_root)
+
+    status['bytes'] = sum([os.path.getsize(os.path.join(arc_fname,path)) for path in sums])
+    if par['catalog'] is not None:
+        par['catalog'].record(ee['identifier'],'archived',uuid=ee['uuid'],path=os.path.abspath(arc_fname))
+    logging.info('%i members of %s archived in %s'%(len(members),ee['identifier'],arc_fname))
+
+    return 'ok'
+
+# ------------------------------------------------------------------------------
+def extract_product(zip_fname,arc_dir,ee,par,logging):
+    # unpack a downloaded (staged) zip product into arc_dir in one pass,
+    # keeping only the members matching par['Extract_members'] (and the
+    # manifest) if given. The members are unpacked next to the archive and
+    # the product directory (e.g. <identifier>.SEN3) renamed into place, so
+    # it never appears half written. Returns the path of the product.
+    stage_dir = os.path.join(arc_dir,'.'+ee['uuid']+'.extract')
+    if os.path.exists(stage_dir):
+        shutil.rmtree(stage_dir)
+
+    n_kept  = 0
+    n_bytes = 0
+    with zipfile.ZipFile(zip_fname) as zf:
+        names = [info.filename for info in zf.infolist() if not info.filename.endswith('/')]
+        for info in zf.infolist():
+            path = os.path.normpath(info.filename)
+            if info.filename.endswith('/') or os.path.isabs(path) or path.startswith('..'):
                 continue
+            if len(par['Extract_members']) > 0 and os.path.basename(path) not in MANIFESTS and \
+               not member_selected(path.split(os.sep,1)[-1],par['Extract_members']):
+                continue
+            fname = os.path.join(stage_dir,path)
+            if not os.path.exists(os.path.dirname(fname)):
+                os.makedirs(os.path.dirname(fname))
+            # zipfile checks the CRC of every member as it is read
+            with zf.open(info) as src, open(fname,'wb') as dst:
+                shutil.copyfileobj(src,dst,par['Buffer_size'])
+            n_kept  = n_kept + 1
+            n_bytes = n_bytes + info.file_size
+
+    # products are zipped as a single <identifier>.SEN3/.SAFE directory
+    tops = set([name.split('/')[0] for name in names])
+    if len(tops) == 1 and os.path.isdir(os.path.join(stage_dir,list(tops)[0])):
+        top_name = list(tops)[0]
+        arc_fname = os.path.join(arc_dir,top_name)
+        os.replace(os.path.join(stage_dir,top_name),arc_fname)
+        shutil.rmtree(stage_dir)
+    else:
+        arc_fname = os.path.join(arc_dir,ee['identifier'])
+        os.replace(stage_dir,arc_fname)
+    os.remove(zip_fname)
 
-            # check file size
-            file_size=-1
-            try:
-                base_fname = r.headers['content-disposition'].split('=')[1].strip('"')
-                file_size  = int(r.headers['content-range'].split('/')[1])
-            except:
-                logging.info('Hub misbehaving, skipping this url')
-                logging.info('>>> '+url_str)
+    logging.info('Extracted %i of %i members (%.1f Mb) of %s into %s'\
+                 %(n_kept,len(names),n_bytes/(1024.*1024.),ee['identifier'],arc_fname))
+
+    return arc_fname
+
+# ------------------------------------------------------------------------------
+def download_product(req_ses,par,ee,logging,status=None):
+    # download a single product into the archive; returns a small status dict
+    # so that the caller can summarise the batch
+    if status is None:
+        status = new_status(ee)
+
+    catalog = par['catalog']
+    if catalog is not None and catalog.is_archived(ee['identifier']):
+        logging.info('Already archived (catalog), skipping: '+ee['identifier'])
+        status['state'] = 'archived'
+        status['bytes_skipped'] = catalog.lookup(ee['identifier'])['size'] or ee.get('size') or 0
+        return status
+
+    # check if the file already exists in the archive
+    arc_dir = archive_dir(par,ee,logging)
+    if arc_dir is None:
+        return status
+
+    fname = os.path.join(arc_dir,ee['identifier']+'*')
+    fnames = glob(fname)
+    if len(fnames) > 0:
+        logging.info('Already archived, skipping: '+fnames[0])
+        if catalog is not None:
+            catalog.record(ee['identifier'],'archived',uuid=ee['uuid'],path=os.path.abspath(fnames[0]),
+                           size=os.path.getsize(fnames[0]) if os.path.isfile(fnames[0]) else None)
+        status['state'] = 'archived'
+        status['bytes_skipped'] = os.path.getsize(fnames[0]) if os.path.isfile(fnames[0]) else ee.get('size') or 0
+        return status
+
+    if catalog is not None:
+        catalog.record(ee['identifier'],'downloading',uuid=ee['uuid'])
+
+    # stage the download next to its destination (same file system, so the
+    # final move is an atomic rename); partial downloads are kept, by uuid,
+    # so that they can be resumed
+    if not os.path.exists(arc_dir):
+        try:
+            os.makedirs(arc_dir)
+        except OSError:
+            # another worker got there first
+            if not os.path.isdir(arc_dir):
+                raise
+
+    # left over from an earlier run: not transferred again
+    status['bytes_skipped'] = bytes_on_disk(os.path.join(arc_dir,'.'+ee['uuid']+'.part'))
+
+    # the hub that answered the query first, then the others, fastest first.
+    # Only failures of the hub itself count against it: a corrupt or
+    # misbehaving product says nothing about the hub
+    hubs    = hub_pool(par)
+    outcome = 'failed'
+    for hub in hubs.ranked(first=ee.get('hub',par['hub'])):
+        status['hub_error'] = False
+        hub_ee = dict(ee,hub=hub)
+        if hub != ee.get('hub',par['hub']):
+            hub_ee['uuid'] = resolve_uuid(req_ses,par,hub,ee['identifier'],logging)
+            if hub_ee['uuid'] is None:
                 continue
+            logging.info('Failing over to '+hub+' for '+ee['identifier'])
+
+        if len(par['Members']) > 0:
+            # selected members only
+            outcome = download_members(req_ses,par,hub_ee,arc_dir,status,logging)
+            if outcome == 'ok':
+                hubs.success(hub)
+                status['state'] = 'downloaded'
+                return status
+            if status['hub_error']:
+                hubs.failure(hub,logging)
+            continue
+
+        part_fname = os.path.join(arc_dir,'.'+hub_ee['uuid']+'.part')
+        outcome,fetched,expected = download_from_hub(req_ses,par,hub_ee,part_fname,status,logging)
+        if outcome == 'ok':
+            # (download times are not search latencies: the ranking is kept)
+            hubs.success(hub)
+            break
+        if status['hub_error']:
+            hubs.failure(hub,logging)
+    else:
+        logging.error('Giving up on '+ee['identifier']+' for now (failed on every hub); partial files kept for next run')
+        if catalog is not None:
+            catalog.record(ee['identifier'],'corrupt' if outcome == 'corrupt' else 'failed')
+        status['state'] = 'failed'
+        return status
+
+    base_fname,checksum = fetched
+    if expected is not None:
+        logging.info('Checksum verified for '+ee['identifier'])
+
+    # get file timestamp
+    timestamp  = os.stat(part_fname).st_mtime
+    status['bytes'] = os.path.getsize(part_fname)
+
+    if par['Extract'] and zipfile.is_zipfile(part_fname):
+        # unpack the staged zip straight into the archive, no zip kept
+        arc_fname = extract_product(part_fname,arc_dir,ee,par,logging)
+        arc_size  = None
+    else:
+        # rename into place (replaces any remnant of an old file)
+        arc_fname = os.path.join(arc_dir,base_fname)
+        os.replace(part_fname,arc_fname)
+        arc_size  = status['bytes']
 
-            # download file to temp dir
-            temp_fname = os.path.join(temp_dir,base_fname)
-            logging.info("Downloading %s ... "%base_fname)
-
-            chunk_count = 0.
-            chunk_size  = 1024
-            iters=np.arange(0,110,10)
-            niter=0
-            with open(temp_fname, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=chunk_size):
-                    chunk_count = chunk_count + chunk_size
-                    if chunk: # filter out keep-alive new chunks
-                        percent_done = float(chunk_count)/float(file_size)*100.
-                        if percent_done >= iters[niter]:
-                            logging.info(str(int(percent_done))+'% complete')
-                            logging.info(str(float(chunk_count/(1024.*1024.)))+' Mb downloaded')
-                            niter = niter+1
-                    f.write(chunk)
-                f.flush()
+    if catalog is not None:
+        catalog.record(ee['identifier'],'archived',uuid=ee['uuid'],path=os.path.abspath(arc_fname),
+                       size=arc_size,checksum=checksum)
 
-            # get file timestamp
-            timestamp  = os.stat(temp_fname).st_mtime
-  
-            # copy from temp to archive
-            if not os.path.exists(arc_dir):
-                os.makedirs(arc_dir)
+    status['state'] = 'downloaded'
 
-            try:
-                shutil.move(temp_fname,arc_dir)
-            except:
-                #remnant of old file:
-                os.remove(arc_dir+'/'+os.path.basename(temp_fname))
-                shutil.move(temp_fname,arc_dir)
+    return status
+
+# ------------------------------------------------------------------------------
+def safe_download_product(req_ses,par,ee,logging):
+    # wrapper that stops a failing product from taking the whole batch down,
+    # and times it for the run metrics
+    status = new_status(ee)
+    t0     = time.time()
+    try:
+        download_product(req_ses,par,ee,logging,status=status)
+    except Exception as err:
+        logging.error('Download of '+ee['identifier']+' failed: '+str(err))
+        if par['catalog'] is not None:
+            par['catalog'].record(ee['identifier'],'failed',uuid=ee['uuid'])
+        status['state'] = 'failed'
+        status['bytes'] = 0
+    status['seconds'] = time.time() - t0
+    par['metrics'].product(status)
+
+    return status
 
-        # delete temp_dir
-        shutil.rmtree(temp_dir)
-        logging.info("Finished downloading!")
+# ------------------------------------------------------------------------------
+def sensing_time(ee):
+    # sensing start of an entry as seconds since the epoch (0 if unknown)
+    try:
+        return (datetime.strptime(ee['beginposition'][:19],'%Y-%m-%dT%H:%M:%S') - datetime(1970,1,1)).total_seconds()
+    except:
+        return 0.
+
+# ------------------------------------------------------------------------------
+def timeliness_rank(ee):
+    # Sentinel-3 timeliness from the identifier: NRT, then STC, then NTC
+    match = re.search('_(NR|ST|NT)_[0-9]{3}$',ee['identifier'])
+    if match is None:
+        return 1
+    return {'NR': 0, 'ST': 1, 'NT': 2}[match.group(1)]
+
+# download priority policies: smaller keys are downloaded first
+PRIORITY_POLICIES = {
+                     'hub': lambda ee: 0,                           # in the order the hub returns them
+                     'newest': lambda ee: -sensing_time(ee),        # most recent sensing time first
+                     'oldest': lambda ee: sensing_time(ee),         # oldest sensing time first
+                     'smallest': lambda ee: ee.get('size') or float('inf'), # smallest products first
+                     'nrt': timeliness_rank,                        # NRT before STC before NTC
+                    }
+
+# ------------------------------------------------------------------------------
+def priority_key(policies):
+    # combine a comma separated list of policies (e.g. 'nrt,newest') into one
+    # sort key, the first policy deciding and the others breaking ties
+    keys = []
+    for name in policies.split(','):
+        if name.strip() not in PRIORITY_POLICIES:
+            raise Exception("Unknown priority policy: "+name+" (one of "+', '.join(sorted(PRIORITY_POLICIES))+")")
+        keys.append(PRIORITY_POLICIES[name.strip()])
+
+    return lambda ee: tuple([key(ee) for key in keys])
+
+# ------------------------------------------------------------------------------
+class DownloadScheduler(object):
+    # hands entries to the download workers, best first. The entries are
+    # pulled from the (paged) query in a background thread, so downloading
+    # starts with the first page and each worker takes the best product known
+    # at the time it becomes free.
+
+    def __init__(self,entries,key):
+        self.key   = key
+        self.heap  = []
+        self.count = 0
+        self.done  = False
+        self.error = None
+        self.cond  = threading.Condition()
+        self.thread = threading.Thread(target=self.fill,args=(entries,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def fill(self,entries):
+        try:
+            for ee in entries:
+                with self.cond:
+                    # the running count keeps equal keys in hub order
+                    heapq.heappush(self.heap,(self.key(ee),self.count,ee))
+                    self.count = self.count + 1
+                    self.cond.notify()
+        except Exception as err:
+            self.error = err
+        finally:
+            with self.cond:
+                self.done = True
+                self.cond.notify_all()
+
+    def get(self):
+        # the next (index in hub order, entry) to download; None once the
+        # query is exhausted
+        with self.cond:
+            while len(self.heap) == 0 and not self.done:
+                self.cond.wait()
+            if len(self.heap) == 0:
+                return None
+            key,index,ee = heapq.heappop(self.heap)
+        return index,ee
+
+# ------------------------------------------------------------------------------
+def download_files(par,entries,logging,req_ses=None):
+    # connection limits shared by all workers
+    par['_hub_slots']  = {}
+    par['_slots_lock'] = threading.Lock()
+
+    # bandwidth shared by all workers
+    par['_bucket'] = None
+    if par['Max_rate'] or par['rate_file']!='':
+        par['_bucket'] = TokenBucket(par['Max_rate'],par['rate_file'],logging)
+
+    # open requests session (unless we are handed one), shared by all workers
+    own_session = req_ses is None
+    if own_session:
+        req_ses = open_session(par)
+
+    try:
+        # ----------------------------------------------------------------------
+        # download files
+        logging.info("Started downloading (%i concurrent, %i per hub, priority: %s) ..."\
+                     %(par['Concurrency'],par['Hub_connections'],par['Priority']))
+        t0 = time.time()
+
+        scheduler = DownloadScheduler(entries,priority_key(par['Priority']))
+        done      = {}
+
+        def worker():
+            while True:
+                item = scheduler.get()
+                if item is None:
+                    return
+                index,ee = item
+                done[index] = safe_download_product(req_ses,par,ee,logging)
+
+        if par['Concurrency'] > 1:
+            with ThreadPoolExecutor(max_workers=par['Concurrency']) as pool:
+                jobs = [pool.submit(worker) for ii in range(par['Concurrency'])]
+                for job in jobs:
+                    job.result()
+        else:
+            worker()
+
+        if scheduler.error is not None:
+            raise scheduler.error
+
+        # results in hub order, whatever order they were downloaded in
+        results = [done[index] for index in sorted(done)]
+        elapsed = max(time.time() - t0, 1.e-6)
+    finally:
+        if own_session:
+            req_ses.close()
+
+    # summarise the batch
+    n_done   = len([res for res in results if res['state']=='downloaded'])
+    n_failed = len([res for res in results if res['state']=='failed'])
+    n_arch   = len([res for res in results if res['state']=='archived'])
+    n_bytes  = sum([res['bytes'] for res in results])
+    logging.info("Finished downloading!")
+    logging.info("%i downloaded, %i failed, %i already archived, %i skipped in %.1f s"\
+                 %(n_done,n_failed,n_arch,len(results)-n_done-n_failed-n_arch,elapsed))
+    logging.info("Throughput: %.3f products/s, %.2f MB/s"\
+                 %(n_done/elapsed,n_bytes/(1024.*1024.)/elapsed))
+
+    return results
+
+# ------------------------------------------------------------------------------
+def write_metrics(par,logging):
+    # end of run: write out the performance records
+    metrics = par['metrics']
+    summary = metrics.summary(par['hub'])
+    logging.info("Queries: %i in %.2f s (%.3f s parsing); mean time to first byte: %s; %i retries"\
+                 %(summary['queries'],summary['query_seconds'],summary['parse_seconds'],
+                   '%.3f s'%(summary['ttfb_seconds']/summary['ttfb_count']) if summary['ttfb_count'] > 0 else 'n/a',
+                   summary['retries']))
+    logging.info("%.1f Mb transferred, %.1f Mb skipped (archived or resumed)"\
+                 %(summary['bytes_transferred']/(1024.*1024.),summary['bytes_skipped']/(1024.*1024.)))
+
+    try:
+        if par['metrics_json']!='':
+            metrics.write_json(par['metrics_json'],par['hub'])
+            logging.info('Metrics appended to '+par['metrics_json'])
+        if par['prom_file']!='':
+            metrics.write_prometheus(par['prom_file'],par['hub'])
+            logging.info('Metrics written to '+par['prom_file'])
+    except (IOError, OSError) as err:
+        # never fail a run over its metrics
+        logging.error('Could not write metrics: '+str(err))
 
     return
 
 # ------------------------------------------------------------------------------
 def default_param():
     par = {
-           'Retries': 1,
+           'Retries': 3,       # retries of a failed request, with exponential backoff
+           'Backoff_factor': 1., # first backoff (s), doubling with every retry
            'Timeout': None,
-           'url':'https://coda.eumetsat.int/',
+           'Probe_timeout': 10., # hub latency probe at startup (s)
+           'Fail_threshold': 3,  # errors in a row after which a hub is left alone...
+           'Hub_cooldown': 300., # ...for this many seconds
+           'Concurrency': 1,   # number of products downloaded at the same time
+           'Hub_connections': 2, # maximum simultaneous connections to any one hub
+           'Resume_retries': 3,  # times an interrupted download is resumed within a run
+           'Segments': 1,        # byte ranges fetched in parallel for large products
+           'Segment_min_size': 500*1024*1024, # products smaller than this are never segmented
+           'Buffer_size': 4*1024*1024, # read/write buffer per download stream (bytes)
+           'Verify_checksum': True, # check downloads against the hub's MD5
+           'Checksum_retries': 2,   # times a corrupt download is fetched again
+           'catalog_file': '', # SQLite product catalog ('' to disable)
+           'catalog': None,    # the open ProductCatalog, see open_catalog
+           'Skip_archived': True, # drop catalogued products from query results
+           'Overlap_hours': 3.,# incremental mode: re-query this far behind the watermark
+           'aoi': None,        # area of interest box (lon1,lat1,lon2,lat2), from the footprint option
+           'Min_coverage': 0., # drop products covering less than this fraction of the aoi
+           'Members': [],      # fetch only these members (file name patterns) of each product, via the Nodes API
+           'Member_concurrency': 4, # members of a product fetched at the same time
+           'Extract': False,   # unpack zipped products into the archive
+           'Extract_members': [], # ...keeping only these members (file name patterns; [] for all)
+           'Priority': 'hub',  # download order: comma separated PRIORITY_POLICIES, e.g. 'nrt,newest'
+           'Max_rate': None,   # total download rate limit (bytes/s, None for unlimited)
+           'rate_file': '',    # file holding a new rate limit (Mb/s) to apply while running
+           'metrics': RunMetrics(), # performance records of this run
+           'metrics_json': '', # append the run's metrics to this JSON lines file ('' for none)
+           'prom_file': '',    # write the run's metrics to this Prometheus textfile ('' for none)
+           'url':'https://coda.eumetsat.int/', # comma separated list of equivalent hubs
            'hub':None,         # eventual hub used to download: one of the urls above.
-           'max_rows': 99      # maximum number of rows to request, increase if need more: but hub limits at 100 (as of 28/10/2016)!
+           'max_rows': 100     # number of rows to request per page: hub limits at 100 (as of 28/10/2016)!
           }
           
     par['req'] = {}
@@ -226,7 +1725,7 @@ def parse_date(date_str,midnight=False):
             if len(date_str)==3:
                 dt = datetime.now()
             elif date_str[3]=='-':
-                dt = datetime.now() - timedelta(days=int(options.date_from[4:]))
+                dt = datetime.now() - timedelta(days=int(date_str[4:]))
             else:
                 raise Exception("Incorrect date!")
         else:
@@ -274,11 +1773,51 @@ def parse_options(options):
  
     if options.url!='': par['url'] = options.url
 
+    par['Retries']        = max(int(options.retries),0)
+    par['Backoff_factor'] = float(options.backoff)
+    par['Timeout']        = float(options.timeout) if float(options.timeout) > 0 else None
+    par['Fail_threshold'] = max(int(options.fail_threshold),1)
+    par['Hub_cooldown']   = float(options.hub_cooldown)
+    par['probe']          = not options.no_probe
+
     if options.logfile!='': par['logfile'] = options.logfile
 
     if options.root_dir!='': par['root_dir'] = options.root_dir
     par['make_sub_dir'] = options.make_sub_dir
 
+    par['Concurrency']     = max(int(options.concurrency),1)
+    par['Hub_connections'] = max(int(options.hub_connections),1)
+    par['Resume_retries']  = max(int(options.resume_retries),0)
+    par['Segments']        = max(int(options.segments),1)
+    par['Segment_min_size'] = int(float(options.segment_min_mb)*1024*1024)
+    par['Buffer_size']     = max(int(float(options.buffer_mb)*1024*1024),64*1024)
+    par['Verify_checksum'] = not options.no_checksum
+    par['Checksum_retries'] = max(int(options.checksum_retries),0)
+
+    if options.no_catalog:
+        par['catalog_file'] = ''
+    elif options.catalog_file!='':
+        par['catalog_file'] = options.catalog_file
+    else:
+        par['catalog_file'] = os.path.join(par['root_dir'],'.product_catalog.db')
+
+    par['incremental']   = options.incremental
+    par['Overlap_hours'] = float(options.overlap_hours)
+
+    par['Members'] = [mm.strip() for mm in options.members.split(',') if mm.strip()!='']
+    par['Member_concurrency'] = max(int(options.member_concurrency),1)
+
+    par['Extract'] = options.extract or options.extract_members!=''
+    par['Extract_members'] = [mm.strip() for mm in options.extract_members.split(',') if mm.strip()!='']
+
+    par['Priority']  = options.priority
+    priority_key(par['Priority'])  # fail early on an unknown policy
+    par['Max_rate']  = float(options.max_rate)*1024*1024 if float(options.max_rate) > 0 else None
+    par['rate_file'] = options.rate_file
+
+    par['metrics_json'] = options.metrics_json
+    par['prom_file']    = options.prom_file
+
     if options.footprint!='':
         latlon = options.footprint.strip().split(':')
     
@@ -291,6 +1830,10 @@ def parse_options(options):
         lat2 = latlon2[0].strip()
         lon2 = latlon2[1].strip()
 
+    par['aoi'] = (min(float(lon1),float(lon2)),min(float(lat1),float(lat2)),
+                  max(float(lon1),float(lon2)),max(float(lat1),float(lat2)))
+    par['Min_coverage'] = float(options.min_coverage)/100.
+
     par['req']['footprint'] = '"Intersects(POLYGON((%(lon1)s %(lat1)s,%(lon2)s %(lat1)s,%(lon2)s %(lat2)s,%(lon1)s %(lat2)s,%(lon1)s %(lat1)s)))"'%{'lon1':lon1,'lat1':lat1,'lon2':lon2,'lat2':lat2}
 
     # date-time
@@ -305,10 +1848,9 @@ def parse_options(options):
 # ======================================================================
 # Simple search query: https://scihub.copernicus.eu/twiki/do/view/SciHubUserGuide/3FullTextSearch
 
-# Parsing command line
-if __name__=="__main__":
-
-    # Parse command line
+# ------------------------------------------------------------------------------
+def build_command_line_parser():
+    # the command line options (also used to describe daemon subscriptions)
     command_line_parser = optparse.OptionParser()
 
     command_line_parser.add_option("--date_from", "-f", dest="date_from", default = 'NOW-1',
@@ -324,6 +1866,95 @@ if __name__=="__main__":
                                   help="Add subdirectory (../yyyy/mm/dd/*)",
                                   default=False)
 
+    command_line_parser.add_option("--concurrency","-c", dest="concurrency", default = 1, type="int",
+                                  help="Number of products to download at the same time")
+
+    command_line_parser.add_option("--hub_connections", dest="hub_connections", default = 2, type="int",
+                                  help="Maximum number of simultaneous connections to any one hub")
+
+    command_line_parser.add_option("--buffer_mb", dest="buffer_mb", default = 4., type="float",
+                                  help="Read/write buffer per download stream (Mb)")
+
+    command_line_parser.add_option("--resume_retries", dest="resume_retries", default = 3, type="int",
+                                  help="Number of times an interrupted download is resumed before giving up")
+
+    command_line_parser.add_option("--segments", dest="segments", default = 1, type="int",
+                                  help="Number of byte ranges to fetch in parallel for large products (within --hub_connections)")
+
+    command_line_parser.add_option("--segment_min_mb", dest="segment_min_mb", default = 500., type="float",
+                                  help="Only segment products larger than this (Mb)")
+
+    command_line_parser.add_option("--no_checksum", dest="no_checksum", action="store_true", default=False,
+                                  help="Do not verify downloads against the hub's MD5 checksum")
+
+    command_line_parser.add_option("--checksum_retries", dest="checksum_retries", default = 2, type="int",
+                                  help="Number of times a download failing its checksum is fetched again")
+
+    command_line_parser.add_option("--catalog", dest="catalog_file", default = '',
+                                  help="Product catalog file (default: root_dir/.product_catalog.db)")
+
+    command_line_parser.add_option("--no_catalog", dest="no_catalog", action="store_true", default=False,
+                                  help="Do not use the product catalog")
+
+    command_line_parser.add_option("--rebuild_catalog", dest="rebuild_catalog", action="store_true", default=False,
+                                  help="Rebuild the product catalog by scanning root_dir before querying")
+
+    command_line_parser.add_option("--incremental", dest="incremental", action="store_true", default=False,
+                                  help="Only query products ingested since the last run of the same query (needs the catalog)")
+
+    command_line_parser.add_option("--overlap_hours", dest="overlap_hours", default = 3., type="float",
+                                  help="Incremental mode: hours re-queried before the watermark, for late arrivals")
+
+    command_line_parser.add_option("--timeout", dest="timeout", default = 60., type="float",
+                                  help="Connect/read timeout of every request (s, 0 for none)")
+
+    command_line_parser.add_option("--retries", dest="retries", default = 3, type="int",
+                                  help="Retries of a failed request, with exponential backoff")
+
+    command_line_parser.add_option("--backoff", dest="backoff", default = 1., type="float",
+                                  help="First retry backoff (s), doubled at every retry")
+
+    command_line_parser.add_option("--fail_threshold", dest="fail_threshold", default = 3, type="int",
+                                  help="Errors in a row after which a hub is left alone (failing over to the next one)")
+
+    command_line_parser.add_option("--hub_cooldown", dest="hub_cooldown", default = 300., type="float",
+                                  help="Seconds a failing hub is left alone before it is tried again")
+
+    command_line_parser.add_option("--no_probe", dest="no_probe", action="store_true", default=False,
+                                  help="Do not probe the hubs for latency at startup (use them in the order given)")
+
+    command_line_parser.add_option("--min_coverage", dest="min_coverage", default = 0., type="float",
+                                  help="Only download products whose footprint covers at least this percentage of the footprint box")
+
+    command_line_parser.add_option("--members", dest="members", default = '',
+                                  help="Only fetch these members of each product (comma separated file names or patterns, "
+                                       "e.g. chl_nn.nc,wqsf.nc,tie_geo_coordinates.nc), plus its manifest")
+
+    command_line_parser.add_option("--member_concurrency", dest="member_concurrency", default = 4, type="int",
+                                  help="Members of a product fetched at the same time (within --hub_connections)")
+
+    command_line_parser.add_option("--extract", dest="extract", action="store_true", default=False,
+                                  help="Unpack zipped products into the archive (root_dir/.../<identifier>.SEN3) instead of keeping the zip")
+
+    command_line_parser.add_option("--extract_members", dest="extract_members", default = '',
+                                  help="Unpack only these members (comma separated file names or patterns) plus the manifest; implies --extract")
+
+    command_line_parser.add_option("--priority", dest="priority", default = 'hub',
+                                  help="Download order, comma separated in order of importance: "
+                                       "hub, newest, oldest, smallest, nrt (e.g. nrt,newest)")
+
+    command_line_parser.add_option("--max_rate", dest="max_rate", default = 0., type="float",
+                                  help="Total download rate limit (Mb/s, 0 for unlimited)")
+
+    command_line_parser.add_option("--rate_file", dest="rate_file", default = '',
+                                  help="File holding a rate limit (Mb/s) that replaces --max_rate whenever it is changed")
+
+    command_line_parser.add_option("--metrics_json", dest="metrics_json", default = '',
+                                  help="Append query and download metrics to this JSON lines file")
+
+    command_line_parser.add_option("--prom_file", dest="prom_file", default = '',
+                                  help="Write run metrics to this Prometheus textfile-collector file (*.prom; counters add up over runs)")
+
     command_line_parser.add_option("--plat","-l", dest="platform_name", default = 'Sentinel-3',
                                   help="Platform name: Sentinel-1, Sentinel-2, Sentinel-3")
 
@@ -359,9 +1990,13 @@ if __name__=="__main__":
 
     command_line_parser.add_option("--url", "-u", dest="url",
                                default="",
-                               help="Username")
+                               help="Hub url, or comma separated list of equivalent hubs to fail over between")
     
-    options,arguments = command_line_parser.parse_args()
+    return command_line_parser
+
+# Parsing command line
+if __name__=="__main__":
+    options,arguments = build_command_line_parser().parse_args()
 
 #-------------------------------------------------------------------------------
 #-main----
@@ -380,11 +2015,33 @@ if __name__ == "__main__":
     except:
         raise Exception("Failed to set logger")
 
-    # off we go
+    # rank the hubs by latency
+    if par['probe'] and len(hub_pool(par).hubs) > 1:
+        probe_ses = open_session(par)
+        hub_pool(par).probe(probe_ses,par,logging)
+        probe_ses.close()
+
+    # products we already hold are skipped using the catalog
+    par = open_catalog(par,logging,rebuild=options.rebuild_catalog)
+    if par['incremental']:
+        par = apply_watermark(par,logging)
+
+    # off we go: entries are fetched page by page while downloading
     entries = process_request(par,logging)
+    results = download_files(par,entries,logging)
+
+    if par['incremental']:
+        update_watermark(par,results,logging)
+
+    write_metrics(par,logging)
+
+    if par['catalog'] is not None:
+        par['catalog'].close()
 
-    if entries:
-        download_files(par,entries,logging)
+    if not par['_query_complete']:
+        # some of the results were never fetched: not a successful run
+        print("Query incomplete, see "+logfile)
+        sys.exit(1)
 
     logging.info("Done")
 
@@ -0,0 +1,53 @@
+'''
+    Purpose:    Check that rebuild_catalog finds products under every name the downloader gives them
+    Version:    v1.0 10/2026
+    Notes:      This code is offered with no warranty and under the MIT licence.
+
+    Usage:
+    python -m pytest test_rebuild_catalog.py
+
+'''
+
+import os
+import logging
+
+import Universal_Sentinel_Downloader as usd
+
+# ------------------------------------------------------------------------------
+IDENTIFIER = 'S3A_OL_2_WFR____20181001T101010_20181001T101310_20181002T120000_0179_036_%03i_2160_MAR_O_NT_002'
+
+# ------------------------------------------------------------------------------
+def test_rebuild_catalog(tmp_path):
+    # one product per naming form, in the dated layout and flat, plus files
+    # that are not products
+    root_dir = tmp_path / 'store'
+    day_dir  = root_dir / '2018' / '10' / '01'
+    day_dir.mkdir(parents=True)
+
+    products = {}
+    for ii,name in enumerate(['%s','%s.zip','%s.SEN3','%s.SAFE','%s.SEN3.zip','%s.SAFE.zip']):
+        identifier = IDENTIFIER%ii
+        path = (day_dir if ii%2 == 0 else root_dir) / (name%identifier)
+        if name.endswith('.SEN3') or name.endswith('.SAFE'):
+            path.mkdir()
+            (path / 'xfdumanifest.xml').write_bytes(b'<manifest/>')
+        else:
+            path.write_bytes(b'x'*(ii+1))
+        products[identifier] = path
+
+    (day_dir / ((IDENTIFIER%99)+'.zip.part')).write_bytes(b'partial')
+    (day_dir / 'notes.txt').write_bytes(b'not a product')
+
+    par = {'root_dir': str(root_dir), 'catalog': usd.ProductCatalog(str(tmp_path / 'catalog.db'))}
+    try:
+        assert usd.rebuild_catalog(par,logging) == len(products)
+        for identifier,path in products.items():
+            rec = par['catalog'].lookup(identifier)
+            assert rec is not None and rec['state'] == 'archived'
+            assert rec['path'] == os.path.abspath(str(path))
+            assert par['catalog'].is_archived(identifier)
+        assert par['catalog'].lookup(IDENTIFIER%99) is None
+    finally:
+        par['catalog'].close()
+
+#-EOF
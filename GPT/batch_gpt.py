@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+'''
+    Purpose:    Parallel, restartable batch processing of S3 OLCI L1 products with SNAP's GPT
+    Version:    v1.0 10/2026
+    Notes:      This code is offered with no warranty and under the MIT licence.
+
+    The batch version of batch_gpt.ipynb. Every *xfdumanifest.xml under the
+    input directory is run through the graph in config_template.xml
+    (SOURCE_PRODUCT and OUTPUT_PRODUCT are replaced by the input and output
+    files), --jobs products at a time. Each gpt gets a thread (-q) and
+    memory (-J-Xmx, -c) budget so that the jobs share the machine.
+
+    Outputs are written under a temporary name and renamed when gpt
+    succeeds, so an output file is always complete. Inputs whose output is
+    already there and opens cleanly are skipped, and the state of every job
+    is kept in a state file, so an interrupted batch picks up where it
+    stopped.
+
+    Usage:
+    /opt/local/bin/python3.6 batch_gpt.py -g /Applications/snap/bin/gpt -i GPT_L1_input -o GPT_L2_output -j 8 -t 4 -m 6G
+'''
+
+import os
+import re
+import sys
+import json
+import time
+import fnmatch
+import logging
+import optparse
+import threading
+import subprocess
+from datetime import datetime
+from xml.sax.saxutils import escape
+from concurrent.futures import ThreadPoolExecutor
+
+from netCDF4 import Dataset
+
+OUTPUT_SUFFIX = '_SUBSET_IDEPIX_C2RCC.nc'
+
+# ------------------------------------------------------------------------------
+class JobState(object):
+    # state of every job of a batch, kept in a JSON file that is rewritten
+    # (atomically) whenever a job changes state
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.lock  = threading.Lock()
+        self.jobs  = {}
+        if os.path.exists(fname):
+            try:
+                with open(fname) as f:
+                    self.jobs = json.load(f)
+            except (IOError, ValueError):
+                self.jobs = {}
+
+    def get(self, input_file):
+        return self.jobs.get(input_file, {})
+
+    def set(self, input_file, **fields):
+        with self.lock:
+            self.jobs.setdefault(input_file, {}).update(fields)
+            with open(self.fname+'.tmp', 'w') as f:
+                json.dump(self.jobs, f, indent=1, sort_keys=True)
+            os.replace(self.fname+'.tmp', self.fname)
+
+# ------------------------------------------------------------------------------
+def find_inputs(input_dir):
+    # all the L1 products (their manifests) under input_dir
+    input_files = []
+    for root, _, filenames in os.walk(input_dir):
+        for filename in fnmatch.filter(filenames, '*xfdumanifest.xml'):
+            input_files.append(os.path.join(root, filename))
+
+    return sorted(input_files)
+
+# ------------------------------------------------------------------------------
+def output_name(input_file, input_dir, output_dir):
+    # output file of an input product, at the same place under output_dir
+    rel_path = os.path.relpath(os.path.dirname(input_file), input_dir)
+
+    return os.path.join(output_dir, rel_path.replace('.SEN3', '') + OUTPUT_SUFFIX)
+
+# ------------------------------------------------------------------------------
+def render_graph(template, values):
+    # the graph with every placeholder replaced, in one pass
+    pattern = re.compile('|'.join([re.escape(key) for key in values]))
+
+    return pattern.sub(lambda match: escape(values[match.group(0)]), template)
+
+# ------------------------------------------------------------------------------
+def valid_output(fname):
+    # does fname hold a complete NetCDF file?
+    if not os.path.exists(fname) or os.path.getsize(fname) == 0:
+        return False
+    try:
+        with Dataset(fname) as nc:
+            return len(nc.variables) > 0
+    except:
+        return False
+
+# ------------------------------------------------------------------------------
+def gpt_command(par, graph_file):
+    # the gpt call for one job, with its share of the machine
+    command = [par['gpt'], graph_file, '-q', str(par['threads'])]
+    if par['memory']:
+        command.append('-J-Xmx'+par['memory'])
+    if par['cache']:
+        command += ['-c', par['cache']]
+
+    return command
+
+# ------------------------------------------------------------------------------
+def run_job(par, template, state, input_file, output_file, logging):
+    # process one product; returns its final state
+    base_name  = os.path.splitext(output_file)[0]
+    tmp_file   = base_name + '.part.nc'
+    graph_file = base_name + '_graph.xml'
+    log_file   = base_name + '_gpt.log'
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+
+    with open(graph_file, 'w') as f:
+        f.write(render_graph(template, {'SOURCE_PRODUCT': input_file, 'OUTPUT_PRODUCT': tmp_file}))
+
+    command = gpt_command(par, graph_file)
+    attempts = state.get(input_file).get('attempts', 0) + 1
+    state.set(input_file, state='running', output=output_file, attempts=attempts,
+              started=datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'))
+    logging.info('Processing: '+input_file)
+    logging.info(' '.join(command))
+
+    t0 = time.time()
+    with open(log_file, 'w') as log:
+        try:
+            returncode = subprocess.call(command, stdout=log, stderr=subprocess.STDOUT)
+        except OSError as err:
+            log.write('Cannot run gpt: %s\n'%err)
+            returncode = -1
+    seconds = round(time.time() - t0, 1)
+
+    if returncode == 0 and valid_output(tmp_file):
+        os.replace(tmp_file, output_file)
+        state.set(input_file, state='done', returncode=returncode, seconds=seconds)
+        logging.info('Done in %.0f s: %s'%(seconds, output_file))
+        return 'done'
+
+    if os.path.exists(tmp_file):
+        os.remove(tmp_file)
+    state.set(input_file, state='failed', returncode=returncode, seconds=seconds)
+    logging.error('GPT failed (code %i) for %s, see %s'%(returncode, input_file, log_file))
+
+    return 'failed'
+
+# ------------------------------------------------------------------------------
+def run_batch(par, logging):
+    # run every input that has no valid output yet, par['jobs'] at a time
+    with open(par['graph']) as f:
+        template = f.read()
+    if not os.path.exists(par['output_dir']):
+        os.makedirs(par['output_dir'])
+    state = JobState(par['state_file'])
+
+    todo    = []
+    skipped = 0
+    for input_file in find_inputs(par['input_dir']):
+        output_file = output_name(input_file, par['input_dir'], par['output_dir'])
+        if not par['force'] and valid_output(output_file):
+            if state.get(input_file).get('state') != 'done':
+                state.set(input_file, state='done', output=output_file)
+            skipped = skipped + 1
+            continue
+        todo.append((input_file, output_file))
+    logging.info('%i products to process, %i already done'%(len(todo), skipped))
+    print('%i products to process, %i already done'%(len(todo), skipped))
+
+    if par['dry_run']:
+        for input_file, output_file in todo:
+            print(' '.join(gpt_command(par, os.path.splitext(output_file)[0] + '_graph.xml')))
+        return []
+
+    with ThreadPoolExecutor(max_workers=par['jobs']) as pool:
+        futures = [pool.submit(run_job, par, template, state, input_file, output_file, logging)
+                   for input_file, output_file in todo]
+        results = [future.result() for future in futures]
+
+    return results
+
+# ======================================================================
+if __name__=="__main__":
+
+    command_line_parser = optparse.OptionParser()
+
+    command_line_parser.add_option("--gpt", "-g", dest="gpt", default = '/Applications/snap/bin/gpt',
+                                  help="Path to the GPT executable")
+
+    command_line_parser.add_option("--graph", "-x", dest="graph", default = os.path.join(os.getcwd(),'config_template.xml'),
+                                  help="Graph template (with SOURCE_PRODUCT and OUTPUT_PRODUCT)")
+
+    command_line_parser.add_option("--input_dir", "-i", dest="input_dir", default = os.path.join(os.getcwd(),'GPT_L1_input'),
+                                  help="Directory searched for L1 products")
+
+    command_line_parser.add_option("--output_dir", "-o", dest="output_dir", default = os.path.join(os.getcwd(),'GPT_L2_output'),
+                                  help="Output directory")
+
+    command_line_parser.add_option("--threads", "-t", dest="threads", default = 4, type="int",
+                                  help="Threads per gpt job (gpt -q)")
+
+    command_line_parser.add_option("--jobs", "-j", dest="jobs", default = 0, type="int",
+                                  help="Number of gpt jobs at the same time (default: cores / threads)")
+
+    command_line_parser.add_option("--memory", "-m", dest="memory", default = '4G',
+                                  help="Java heap per gpt job (gpt -J-Xmx), empty for the gpt default")
+
+    command_line_parser.add_option("--cache", "-c", dest="cache", default = '',
+                                  help="Tile cache per gpt job (gpt -c), e.g. 2048M")
+
+    command_line_parser.add_option("--state_file", "-s", dest="state_file", default = None,
+                                  help="Job state file (default: .batch_gpt_state.json in the output directory)")
+
+    command_line_parser.add_option("--force", dest="force", action="store_true", default=False,
+                                  help="Process products that already have an output")
+
+    command_line_parser.add_option("--dry_run", dest="dry_run", action="store_true", default=False,
+                                  help="Only print the gpt calls")
+
+    command_line_parser.add_option("--logfile", "-z", dest="logfile", default = 'Batch_GPT_log',
+                                  help="Log file")
+
+    options,arguments = command_line_parser.parse_args()
+
+#-------------------------------------------------------------------------------
+#-main----
+if __name__ == "__main__":
+    logfile = options.logfile+"_"+datetime.now().strftime('%Y%m%d_%H%M%S')+".log"
+
+    # set file logger
+    try:
+        if os.path.exists(logfile):
+            os.remove(logfile)
+        logging.basicConfig(filename=logfile,level=logging.INFO)
+        print("Logging to: "+logfile)
+    except:
+        raise Exception("Failed to set logger")
+
+    par = {'gpt':        options.gpt,
+           'graph':      options.graph,
+           'input_dir':  os.path.abspath(options.input_dir),
+           'output_dir': os.path.abspath(options.output_dir),
+           'threads':    max(options.threads, 1),
+           'jobs':       options.jobs,
+           'memory':     options.memory,
+           'cache':      options.cache,
+           'force':      options.force,
+           'dry_run':    options.dry_run}
+    if par['jobs'] <= 0:
+        par['jobs'] = max((os.cpu_count() or 1) // par['threads'], 1)
+    par['state_file'] = options.state_file or os.path.join(par['output_dir'], '.batch_gpt_state.json')
+
+    results = run_batch(par, logging)
+
+    n_done = len([res for res in results if res == 'done'])
+    logging.info('%i of %i products processed'%(n_done, len(results)))
+    print('%i of %i products processed, state in %s'%(n_done, len(results), par['state_file']))
+    if n_done < len(results):
+        sys.exit(1)
+
+#-EOF
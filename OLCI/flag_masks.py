@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+'''
+    Purpose:    Flag masks for Sentinel-3 quality flag variables
+    Version:    v1.0 10/2026
+    Notes:      This code is offered with no warranty and under the MIT licence.
+
+    Works with any CF flag variable: bit flags described by flag_masks
+    (OLCI WQSF, SLSTR l2p_flags, ...) and enumerated flags described by
+    flag_values (SLSTR quality_level, ...), with flag_meanings naming them.
+
+    The flag attributes of a product type are parsed once (flag_set caches
+    them), and the bitmask of each list of flags is worked out once. Masks
+    are evaluated a block of rows at a time into one boolean array, so no
+    full scene temporaries are made, and a netCDF variable can be passed in
+    directly: only one block of it is read at a time.
+
+    Usage:
+    flags     = flag_set(FLAG_file['WQSF'])
+    flag_mask = flags.mask(FLAG_file['WQSF'], ['CLOUD', 'INVALID', 'HIGHGLINT'])
+'''
+#-imports-----------------------------------------------------------------------
+import numpy as np
+
+#-constants---------------------------------------------------------------------
+# rows of flag data evaluated at a time
+BLOCK_ROWS = 256
+
+#-classes-----------------------------------------------------------------------
+class FlagSet(object):
+    # the flags of one flag variable (of one product type)
+
+    def __init__(self, flag_meanings, flag_masks=None, flag_values=None, dtype=np.uint64):
+        self.names    = str(flag_meanings).split()
+        self.dtype    = np.dtype(dtype)
+        self.bitwise  = flag_masks is not None
+        values        = flag_masks if self.bitwise else flag_values
+        self.values   = np.atleast_1d(np.asarray(values)).astype(self.dtype)
+        self.index    = dict([(name, ii) for ii, name in enumerate(self.names)])
+        self.compiled = {}
+
+    def bits(self, flags):
+        # bitmask (or list of values) of a list of flag names, worked out
+        # once per list
+        key = tuple(flags)
+        if key not in self.compiled:
+            selected = []
+            for flag in flags:
+                if flag in self.index:
+                    selected.append(self.values[self.index[flag]])
+                else:
+                    print(flag + " not present")
+            if self.bitwise:
+                bits = self.dtype.type(0)
+                for value in selected:
+                    bits = bits | value
+                self.compiled[key] = bits
+            else:
+                self.compiled[key] = np.array(selected, dtype=self.dtype)
+
+        return self.compiled[key]
+
+    def mask(self, flag_data, flags, out=None, block_rows=BLOCK_ROWS):
+        # True where any of flags is set in flag_data (an array or a netCDF
+        # variable), a block of rows at a time; the result goes in out if
+        # it is given
+        bits  = self.bits(flags)
+        shape = flag_data.shape
+        if out is None:
+            out = np.empty(shape, dtype=bool)
+        if len(shape) == 0 or shape[0] == 0:
+            out[...] = self.evaluate(np.asarray(flag_data[...]), bits)
+            return out
+
+        scratch = None
+        for i0 in range(0, shape[0], block_rows):
+            i1 = min(i0+block_rows, shape[0])
+            block = np.ma.getdata(flag_data[i0:i1])
+            if scratch is None or scratch.dtype != block.dtype:
+                scratch = np.empty((block_rows,) + tuple(shape[1:]), dtype=block.dtype)
+            self.evaluate(block, bits, out=out[i0:i1], scratch=scratch[:i1-i0])
+
+        return out
+
+    def evaluate(self, block, bits, out=None, scratch=None):
+        # mask of one block of flag data (scratch: space for the bitwise
+        # and, the shape and type of block)
+        if out is None:
+            out = np.empty(block.shape, dtype=bool)
+        if self.bitwise:
+            if block.dtype.kind in 'iu' and block.dtype != self.dtype:
+                # compare in the type of the data: no converted copy of it
+                bits = np.asarray(bits).astype(block.dtype)
+            np.not_equal(np.bitwise_and(block, bits, out=scratch), 0, out=out)
+        elif block.dtype.itemsize == 1:
+            # small enumerations: one lookup table
+            table = np.zeros(256, dtype=bool)
+            table[bits.astype(block.dtype).view(np.uint8)] = True
+            np.take(table, block.view(np.uint8), out=out)
+        else:
+            out[...] = np.isin(block, bits)
+
+        return out
+
+#-functions---------------------------------------------------------------------
+_flag_sets = {}
+
+def flag_set(variable):
+    # the FlagSet of a netCDF flag variable; product types share one
+    flag_masks  = getattr(variable, 'flag_masks', None)
+    flag_values = getattr(variable, 'flag_values', None)
+    values = flag_masks if flag_masks is not None else flag_values
+    if values is None:
+        raise Exception("Variable has neither flag_masks nor flag_values")
+
+    key = (variable.name, variable.flag_meanings, tuple(np.atleast_1d(values).tolist()),
+           flag_masks is not None)
+    if key not in _flag_sets:
+        _flag_sets[key] = FlagSet(variable.flag_meanings, flag_masks=flag_masks,
+                                  flag_values=None if flag_masks is not None else flag_values,
+                                  dtype=variable.dtype)
+
+    return _flag_sets[key]
+
+def flag_data_fast(flags_we_want, flag_names, flag_values, flag_data, flag_type='WQSF'):
+    # the original notebook interface: True where any of flags_we_want is
+    # set. flag_type is no longer needed (the bits take the data's type)
+    flags = FlagSet(' '.join(flag_names), flag_masks=flag_values,
+                    dtype=np.asarray(flag_values).dtype)
+
+    return flags.mask(flag_data, flags_we_want)
+
+#-EOF
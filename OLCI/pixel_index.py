@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+'''
+    Purpose:    Spatial index of the pixels of an OLCI scene, for fast pixel lookups
+    Version:    v1.0 10/2026
+    Notes:      This code is offered with no warranty and under the MIT licence.
+
+    Finding the pixel nearest a point with spheric_dist means computing the
+    distance to every pixel of the scene, for every point. PixelIndex puts
+    the pixels of a geo_coordinates.nc file in a KD-tree (of their positions
+    as 3-D unit vectors, so that it works anywhere on the globe, across the
+    dateline and at the poles), after which each lookup only visits a few
+    pixels. Lookups take arrays of points, e.g. all the in-situ stations of
+    a matchup at once.
+
+    The pixel positions of a product are read once: pixel_index keeps them
+    next to the geolocation file (as .geo_coordinates.nc.kdtree.npz, plain
+    arrays read without unpickling, as product directories are shared), and
+    reads them again if the geolocation file changes. Needs scipy.
+
+    Usage:
+    index = pixel_index('/path/to/product.SEN3/geo_coordinates.nc')
+    rows, cols, dist = index.nearest(station_lats, station_lons)
+    rows, cols       = index.in_box(14.0, 14.25, 70.0, 70.25)
+'''
+#-imports-----------------------------------------------------------------------
+import os
+import warnings
+
+import numpy as np
+from netCDF4 import Dataset
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+#-constants---------------------------------------------------------------------
+# earth radius (m), as in spheric_dist
+EARTH_RADIUS = 6367442.76
+
+# rows of geolocation read at a time
+BLOCK_ROWS = 512
+
+# tolerance (degrees) of positions recovered from the tree
+ROUNDING = 1.e-9
+
+#-geometry----------------------------------------------------------------------
+def unit_vectors(lat, lon):
+    # positions (degrees) as 3-D unit vectors, one row per position
+    lat = np.radians(np.asarray(lat, dtype=float))
+    lon = np.radians(np.asarray(lon, dtype=float))
+    xyz = np.empty(lat.shape + (3,))
+    xyz[..., 0] = np.cos(lat) * np.cos(lon)
+    xyz[..., 1] = np.cos(lat) * np.sin(lon)
+    xyz[..., 2] = np.sin(lat)
+
+    return xyz
+
+def chord(distance):
+    # straight line distance between unit vectors of points distance (m) apart
+    return 2. * np.sin(np.minimum(np.asarray(distance, dtype=float) / EARTH_RADIUS, np.pi) / 2.)
+
+def arc(chord_length):
+    # distance (m) along the earth of a chord between unit vectors
+    return 2. * EARTH_RADIUS * np.arcsin(np.minimum(np.asarray(chord_length, dtype=float) / 2., 1.))
+
+#-classes-----------------------------------------------------------------------
+class PixelIndex(object):
+    # KD-tree of the valid pixels of a scene
+
+    def __init__(self, lat_var, lon_var, block_rows=BLOCK_ROWS):
+        # lat_var and lon_var can be netCDF variables or arrays; they are
+        # read a block of rows at a time
+        if cKDTree is None:
+            raise Exception("The scipy package is needed for PixelIndex")
+        self.shape = tuple(lat_var.shape)
+        n_rows, n_cols = self.shape
+        xyz    = np.empty((n_rows*n_cols, 3))
+        pixels = np.empty(n_rows*n_cols, dtype=np.int32 if n_rows*n_cols < 2**31 else np.int64)
+        n_valid = 0
+        for i0 in range(0, n_rows, block_rows):
+            i1  = min(i0+block_rows, n_rows)
+            lat = np.ma.filled(np.ma.asarray(lat_var[i0:i1]).astype(float), np.nan)
+            lon = np.ma.filled(np.ma.asarray(lon_var[i0:i1]).astype(float), np.nan)
+            valid = np.isfinite(lat) & np.isfinite(lon)
+            n_block = int(valid.sum())
+            xyz[n_valid:n_valid+n_block]    = unit_vectors(lat[valid], lon[valid])
+            pixels[n_valid:n_valid+n_block] = np.flatnonzero(valid) + i0*n_cols
+            n_valid = n_valid + n_block
+
+        if n_valid < len(pixels):
+            xyz, pixels = xyz[:n_valid].copy(), pixels[:n_valid].copy()
+        self.build(xyz, pixels)
+
+    @classmethod
+    def from_points(cls, shape, xyz, pixels):
+        # a PixelIndex of pixel positions (unit vectors) already worked out
+        if cKDTree is None:
+            raise Exception("The scipy package is needed for PixelIndex")
+        index = cls.__new__(cls)
+        index.shape = tuple(int(nn) for nn in shape)
+        index.build(xyz, pixels)
+
+        return index
+
+    def build(self, xyz, pixels):
+        # flat pixel number of every point of the tree
+        self.pixels = pixels
+        self.tree   = cKDTree(xyz, balanced_tree=False)
+
+    def nearest(self, lat, lon, max_distance=np.inf):
+        # (rows, cols, distances in m) of the pixel nearest each point;
+        # rows and cols are -1 where no pixel is within max_distance
+        points = unit_vectors(np.atleast_1d(lat), np.atleast_1d(lon))
+        limit  = chord(max_distance) if np.isfinite(max_distance) else np.inf
+        dist, found = self.tree.query(points, distance_upper_bound=limit)
+        missing = found >= len(self.pixels)
+        rows, cols = np.divmod(self.pixels[np.where(missing, 0, found)], self.shape[1])
+        rows[missing] = -1
+        cols[missing] = -1
+
+        return rows, cols, np.where(missing, np.inf, arc(dist))
+
+    def within(self, lat, lon, distance):
+        # (rows, cols) of the pixels within distance (m) of each point, one
+        # pair of arrays per point
+        points = unit_vectors(np.atleast_1d(lat), np.atleast_1d(lon))
+        found  = self.tree.query_ball_point(points, chord(distance))
+
+        return [np.divmod(self.pixels[np.asarray(ff, dtype=np.int64)], self.shape[1]) for ff in found]
+
+    def in_box(self, lat_min, lat_max, lon_min, lon_max):
+        # (rows, cols) of the pixels in a lat/lon box (lon_min > lon_max is a
+        # box across the dateline): the pixels within reach of the box
+        # centre, then only those really in the box
+        lon_span = lon_max - lon_min if lon_max >= lon_min else lon_max - lon_min + 360.
+        edge     = np.linspace(0., 1., 17)
+        lats     = lat_min + edge*(lat_max - lat_min)
+        lons     = lon_min + edge*lon_span
+        edge_lat = np.concatenate([lats, lats, [lat_min]*17, [lat_max]*17])
+        edge_lon = np.concatenate([[lon_min]*17, [lon_min+lon_span]*17, lons, lons])
+        centre   = unit_vectors((lat_min + lat_max)/2., lon_min + lon_span/2.)
+        reach    = np.max(np.linalg.norm(unit_vectors(edge_lat, edge_lon) - centre, axis=1))*1.0001 + 1.e-9
+
+        found = np.asarray(self.tree.query_ball_point(centre, reach), dtype=np.int64)
+        xyz   = self.tree.data[found]
+        lat   = np.degrees(np.arcsin(np.clip(xyz[:, 2], -1., 1.)))
+        lon   = np.degrees(np.arctan2(xyz[:, 1], xyz[:, 0]))
+        # (allowing for the rounding of positions to unit vectors and back)
+        inside = (lat >= lat_min - ROUNDING) & (lat <= lat_max + ROUNDING) & \
+                 ((lon - lon_min + ROUNDING) % 360. <= lon_span + 2*ROUNDING)
+
+        return np.divmod(np.sort(self.pixels[found[inside]]), self.shape[1])
+
+#-functions---------------------------------------------------------------------
+_indexes = {}
+
+def pixel_index(geo_fname, cache=True):
+    # the PixelIndex of a geolocation file, built once and its pixel
+    # positions kept on disk next to it (when the product directory can be
+    # written to)
+    geo_fname = os.path.abspath(geo_fname)
+    source    = (os.path.getsize(geo_fname), os.path.getmtime(geo_fname))
+    if geo_fname in _indexes and _indexes[geo_fname][0] == source:
+        return _indexes[geo_fname][1]
+
+    cache_fname = os.path.join(os.path.dirname(geo_fname), '.'+os.path.basename(geo_fname)+'.kdtree.npz')
+    index = None
+    if cache and os.path.exists(cache_fname):
+        try:
+            with np.load(cache_fname, allow_pickle=False) as cached:
+                if tuple(cached['source']) == source:
+                    index = PixelIndex.from_points(cached['shape'], cached['xyz'], cached['pixels'])
+        except (IOError, OSError, ValueError, KeyError):
+            index = None
+
+    if index is None:
+        with Dataset(geo_fname) as geo:
+            index = PixelIndex(geo.variables['latitude'], geo.variables['longitude'])
+        if cache:
+            try:
+                with open(cache_fname+'.tmp', 'wb') as f:
+                    np.savez(f, source=np.array(source, dtype=float), shape=np.array(index.shape),
+                             xyz=index.tree.data, pixels=index.pixels)
+                os.replace(cache_fname+'.tmp', cache_fname)
+            except (IOError, OSError):
+                warnings.warn("Cannot keep the pixel positions in "+cache_fname)
+
+    _indexes[geo_fname] = (source, index)
+
+    return index
+
+#-EOF
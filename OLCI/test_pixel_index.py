@@ -0,0 +1,105 @@
+'''
+    Purpose:    Check the pixel lookups of pixel_index against a brute-force search
+    Version:    v1.0 10/2026
+    Notes:      This code is offered with no warranty and under the MIT licence.
+
+    The scene is a small synthetic swath across the antimeridian, with some
+    missing positions, so that the lookups are checked where the longitudes
+    wrap. Needs scipy (the checks are skipped without it).
+
+    Usage:
+    python -m pytest test_pixel_index.py
+
+'''
+
+import os
+
+import numpy as np
+import pytest
+from netCDF4 import Dataset
+
+pytest.importorskip('scipy')
+
+import pixel_index as pi
+from window_reader import in_box
+
+# ------------------------------------------------------------------------------
+def swath(n_rows=60, n_cols=80):
+    # skewed lat/lon grid from 170E to 170W, with a few missing pixels
+    rows, cols = np.mgrid[0:n_rows, 0:n_cols].astype(float)
+    lat = 40. + 0.3*rows + 0.02*cols
+    lon = 170. + 0.25*cols - 0.03*rows
+    lon = (lon + 180.) % 360. - 180.
+    lat[5, 7] = np.nan
+    lon[33, 60] = np.nan
+
+    return lat, lon
+
+def great_circle(lat1, lon1, lat2, lon2):
+    # haversine distance (m), with the earth radius of spheric_dist
+    lat1, lon1, lat2, lon2 = [np.radians(vv) for vv in (lat1, lon1, lat2, lon2)]
+    hav = np.sin((lat2-lat1)/2.)**2 + np.cos(lat1)*np.cos(lat2)*np.sin((lon2-lon1)/2.)**2
+
+    return 2.*pi.EARTH_RADIUS*np.arcsin(np.sqrt(hav))
+
+def brute_nearest(lat, lon, point_lat, point_lon):
+    # (row, col, distance) of the pixel nearest a point, looking at them all
+    dist = great_circle(lat, lon, point_lat, point_lon)
+    dist = np.where(np.isfinite(dist), dist, np.inf)
+    row, col = np.unravel_index(np.argmin(dist), dist.shape)
+
+    return row, col, dist[row, col]
+
+# ------------------------------------------------------------------------------
+def test_nearest():
+    lat, lon = swath()
+    index = pi.PixelIndex(lat, lon, block_rows=7)
+
+    rng = np.random.RandomState(0)
+    point_lat = np.concatenate([rng.uniform(41., 57., 50), [48., 52., 50.]])
+    point_lon = np.concatenate([rng.uniform(171., 188., 50), [179.99, -179.99, 180.]])
+    point_lon = (point_lon + 180.) % 360. - 180.
+    rows, cols, dist = index.nearest(point_lat, point_lon)
+
+    for ii in range(len(point_lat)):
+        row, col, brute = brute_nearest(lat, lon, point_lat[ii], point_lon[ii])
+        assert abs(dist[ii] - brute) < 1.e-3
+        # (a tie may pick another pixel at the same distance)
+        assert abs(great_circle(lat[rows[ii], cols[ii]], lon[rows[ii], cols[ii]],
+                                point_lat[ii], point_lon[ii]) - brute) < 1.e-3
+
+    # nothing within reach of a point far from the scene
+    rows, cols, dist = index.nearest(0., 0., max_distance=1000.)
+    assert rows[0] == -1 and cols[0] == -1 and np.isinf(dist[0])
+
+def test_in_box():
+    lat, lon = swath()
+    index = pi.PixelIndex(lat, lon)
+    for box in [(45., 50., 175., 179.), (45., 50., 178., -178.), (50., 52., -179., -176.)]:
+        rows, cols = index.in_box(*box)
+        inside = in_box(lat, lon, *box)
+        assert sorted(zip(rows, cols)) == sorted(zip(*np.nonzero(inside)))
+
+def test_cache(tmp_path):
+    lat, lon = swath()
+    geo_fname = str(tmp_path / 'geo_coordinates.nc')
+    with Dataset(geo_fname, 'w') as geo:
+        geo.createDimension('rows', lat.shape[0])
+        geo.createDimension('columns', lat.shape[1])
+        for name, values in (('latitude', lat), ('longitude', lon)):
+            var = geo.createVariable(name, 'f8', ('rows', 'columns'), fill_value=np.nan)
+            var[:] = np.ma.masked_invalid(values)
+
+    built = pi.pixel_index(geo_fname)
+    assert os.path.exists(str(tmp_path / '.geo_coordinates.nc.kdtree.npz'))
+
+    # read back from the cache file, which must not need unpickling
+    pi._indexes.clear()
+    np.load(str(tmp_path / '.geo_coordinates.nc.kdtree.npz'), allow_pickle=False).close()
+    cached = pi.pixel_index(geo_fname)
+    assert cached is not built
+    assert cached.shape == built.shape
+    for result, expected in zip(cached.nearest(50., 179.99), built.nearest(50., 179.99)):
+        assert np.array_equal(result, expected)
+
+#-EOF
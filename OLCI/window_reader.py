@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+'''
+    Purpose:    Read only the part of an OLCI scene that covers a lat/lon box
+    Version:    v1.0 10/2026
+    Notes:      This code is offered with no warranty and under the MIT licence.
+
+    bbox_window finds the smallest row/column window of a scene that holds
+    every pixel of a lat/lon box, reading the geolocation a block of rows at
+    a time. read_window then reads only that window (hyperslab) of any
+    variable of the product (chl_nn.nc, geo_coordinates.nc, wqsf.nc, ...),
+    so memory scales with the area of interest, not with the scene.
+    read_decimated gives a reduced resolution overview of a whole scene in
+    the same way.
+
+    Usage:
+    GEO_file   = nc.Dataset('geo_coordinates.nc')
+    window     = bbox_window(GEO_file['latitude'], GEO_file['longitude'], 5., 25., 55., 75.)
+    CHL_subset = read_window(OLCI_file['CHL_NN'], window)
+'''
+#-imports-----------------------------------------------------------------------
+import numpy as np
+
+#-constants---------------------------------------------------------------------
+# rows of geolocation (or data) read at a time
+BLOCK_ROWS = 512
+
+#-functions---------------------------------------------------------------------
+def in_box(lat, lon, lat_min, lat_max, lon_min, lon_max):
+    # which pixels are in the box; lon_min > lon_max is a box across the
+    # dateline. Missing (nan) positions are never in it
+    inside = (lat >= lat_min) & (lat <= lat_max)
+    if lon_min <= lon_max:
+        inside &= (lon >= lon_min) & (lon <= lon_max)
+    else:
+        inside &= (lon >= lon_min) | (lon <= lon_max)
+
+    return inside
+
+def bbox_window(lat_var, lon_var, lat_min, lat_max, lon_min, lon_max, block_rows=BLOCK_ROWS):
+    # smallest (row1, row2, col1, col2) window of the scene holding every
+    # pixel of the box; lat_var and lon_var can be netCDF variables or arrays
+    row1, row2 = None, None
+    cols = np.zeros(lat_var.shape[-1], dtype=bool)
+    for i0 in range(0, lat_var.shape[0], block_rows):
+        i1  = min(i0+block_rows, lat_var.shape[0])
+        lat = np.ma.filled(np.ma.asarray(lat_var[i0:i1]).astype(float), np.nan)
+        lon = np.ma.filled(np.ma.asarray(lon_var[i0:i1]).astype(float), np.nan)
+        inside = in_box(lat, lon, lat_min, lat_max, lon_min, lon_max)
+        rows = np.nonzero(inside.any(axis=1))[0]
+        if len(rows) == 0:
+            continue
+        if row1 is None:
+            row1 = i0 + rows[0]
+        row2 = i0 + rows[-1] + 1
+        cols |= inside.any(axis=0)
+
+    if row1 is None:
+        raise Exception("No pixel of the scene is in the box")
+    cols = np.nonzero(cols)[0]
+
+    return int(row1), int(row2), int(cols[0]), int(cols[-1]) + 1
+
+def read_window(variable, window):
+    # the (row1, row2, col1, col2) window of a variable: only this part is
+    # read from the file
+    row1, row2, col1, col2 = window
+
+    return variable[..., row1:row2, col1:col2]
+
+def read_decimated(variable, step, block_rows=BLOCK_ROWS):
+    # every step-th pixel of every step-th row of a variable, read a block
+    # of rows at a time (faster than a strided read of the file)
+    block_rows = max(block_rows // step, 1) * step
+    blocks = []
+    for i0 in range(0, variable.shape[0], block_rows):
+        i1 = min(i0+block_rows, variable.shape[0])
+        blocks.append(variable[i0:i1][::step, ::step])
+
+    return np.ma.concatenate(blocks)
+
+#-EOF